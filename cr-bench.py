@@ -0,0 +1,110 @@
+#!./venv/bin/python
+import argparse
+import random
+import time
+import tracemalloc
+
+cr_conf = __import__('cr-conf')
+cf = cr_conf.conf
+cru = __import__('cr-update')
+
+
+class ListGearDB():
+    # the original GearDB layout, a list of row tuples and a dict of dicts
+    def __init__(self):
+        self._rows = [None]
+        self._gearids = {}
+
+    @property
+    def last_local_id(self):
+        nrows = len(self._rows)
+        return nrows - 1 if nrows > 1 else None
+
+    def _add_gear(self, hash, raider_id, slot, name, stats):
+        self._rows.append((hash, raider_id, slot, name) + tuple(stats))
+        self._gearids.setdefault(raider_id, {})[hash] = self.last_local_id
+
+    def _get_localid(self, raider_id, hash):
+        return self._gearids.get(raider_id, {}).get(hash)
+
+
+def fake_gear(count, seed=0):
+    rnd = random.Random(seed)
+    names = ['Bench Item %d' % (i,) for i in range(400)]
+    rows = []
+    for _ in range(count):
+        name = rnd.choice(names)
+        stats = tuple(rnd.randint(0, 40) for _ in cf.stat_names)
+        rows.append((cru.hash_gear_uniq(name, *stats),
+                     rnd.randint(1, max(1, count // 40)),
+                     rnd.choice(cf.slot_names), name, stats))
+    return rows
+
+
+def bench_geardb(count):
+    rows = fake_gear(count)
+    print('%d gear rows' % (count,))
+    print('%-10s %12s %9s %9s %9s' % (
+        'layout', 'bytes', 'per row', 'add', 'lookup'))
+    for label, factory in (('list', ListGearDB), ('compact', cru.GearDB)):
+        tracemalloc.start()
+        geardb = factory()
+        for row in rows:
+            geardb._add_gear(*row)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del geardb
+
+        # timed separately, tracemalloc slows down allocation a lot
+        start = time.perf_counter()
+        geardb = factory()
+        for row in rows:
+            geardb._add_gear(*row)
+        added = time.perf_counter() - start
+        start = time.perf_counter()
+        for row in rows:
+            geardb._get_localid(row[1], row[0])
+        lookup = time.perf_counter() - start
+        print('%-10s %12d %9.1f %8.2fs %8.2fs' % (
+            label, size, size / count, added, lookup))
+
+
+def bench_hash(count):
+    rows = [(name, stats) for hash, raider, slot, name, stats
+            in fake_gear(count)]
+    print('%d items' % (count,))
+    start = time.perf_counter()
+    single = [cru.hash_gear_uniq(name, *stats) for name, stats in rows]
+    single_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    bulk = cru.hash_gear_uniq_many(rows)
+    bulk_secs = time.perf_counter() - start
+    assert single == bulk
+    print('%-10s %8.3fs %10.0f/s' % (
+        'single', single_secs, count / single_secs))
+    print('%-10s %8.3fs %10.0f/s' % ('bulk', bulk_secs, count / bulk_secs))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+
+    p_geardb = subparsers.add_parser(
+        'geardb', help='Compare GearDB memory use with the list layout')
+    p_geardb.add_argument('-n', dest='count', type=int, default=200000,
+                          help='Number of gear rows')
+
+    p_hash = subparsers.add_parser(
+        'hash', help='Compare bulk and single item gear hashing')
+    p_hash.add_argument('-n', dest='count', type=int, default=100000,
+                        help='Number of items')
+    args = parser.parse_args()
+
+    if args.cmd == 'geardb':
+        bench_geardb(args.count)
+    elif args.cmd == 'hash':
+        bench_hash(args.count)
+
+
+if __name__ == '__main__':
+    main()
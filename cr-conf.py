@@ -21,6 +21,8 @@ class CRConf():
         self._conf_path = os.path.join(self._confdir, 'crutil.ini')
         self._abidir = os.path.join(self._datadir, 'abi')
         self.db_path = os.path.join(self._datadir, 'raiders.sqlite')
+        self.sim_cache_path = os.path.join(self._datadir, 'simcache.sqlite')
+        self.download_dir = os.path.join(self._datadir, 'downloads')
         self.cr_authtoken_path = os.path.join(self._datadir, 'cr-authtok.json')
         # note: this is returned by recruiting contract method raidersAddress
         self.nft_contract = '0xfd12ec7ea4b381a79c78fe8b2248b4c559011ffb'
@@ -48,6 +50,7 @@ class CRConf():
             '0xc81f43Eb261c1708bFfA84D75DDd945341723f1F': 'sporebark-quest',
             '0xe193364370F0E2923b41a8d1850F442B45E5ccA7': 'grimweed-quest',
             '0xF001508171344A4bc90fdA37890e343749d5D216': 'recruiting-history',
+            '0xcA11bde05977b3631167028862bE2a173976CA11': 'multicall3',
         }
         self._contracts = {v: k for k, v in self._contract_names.items()}
         self._quest_names = {
@@ -105,6 +108,8 @@ class CRConf():
             os.makedirs(self._abidir)
         if not os.path.exists(self._datadir):
             os.makedirs(self._datadir)
+        if not os.path.exists(self.download_dir):
+            os.makedirs(self.download_dir)
 
     def _schema_loaded(self, schema):
         for sect in schema.keys():
@@ -233,6 +238,48 @@ class CRConf():
         abi = self._get_eth_abi(name, session=session)
         return w3.eth.contract(address=self._contracts[name], abi=abi)
 
+    def eth_multicall(self, calls, session=None):
+        # make several contract function calls, such as
+        # contract.functions.foo(1), with a single Multicall3 eth_call.
+        # returns a (success, result) tuple for each call
+        if not calls:
+            return []
+        w3 = self.get_polygon_web3(session=session)
+        multicall = self.get_eth_contract('multicall3', session=session)
+        contracts = {}
+        args = []
+        for fn in calls:
+            if fn.address not in contracts:
+                contracts[fn.address] = w3.eth.contract(
+                    address=fn.address, abi=fn.contract_abi)
+            contract = contracts[fn.address]
+            # web3 7 renamed encodeABI to encode_abi
+            encode = getattr(contract, 'encode_abi', None) or \
+                contract.encodeABI
+            args.append((fn.address, True, encode(fn.fn_name, args=fn.args)))
+        res = []
+        for fn, (ok, data) in zip(
+                calls, multicall.functions.aggregate3(args).call()):
+            if not ok:
+                res.append((False, None))
+                continue
+            # XXX tuple outputs are not supported
+            types = [i['type'] for i in fn.abi['outputs']]
+            vals = self._eth_decode(w3, types, data)
+            res.append((True, vals[0] if len(vals) == 1 else tuple(vals)))
+        return res
+
+    def _eth_decode(self, w3, types, data):
+        # eth-abi 4 renamed decode_abi to decode, and web3 6 renamed
+        # toChecksumAddress. addresses are checksummed like web3 does for
+        # a plain call()
+        from web3 import Web3
+        decode = getattr(w3.codec, 'decode', None) or w3.codec.decode_abi
+        checksum = getattr(Web3, 'to_checksum_address', None) or \
+            Web3.toChecksumAddress
+        return [checksum(v) if t == 'address' else v
+                for t, v in zip(types, decode(types, data))]
+
     def get_quest_name(self, name=None, address=None, short=False):
         assert (name is None) != (address is None)
         if name is None:
@@ -251,10 +298,14 @@ class CRConf():
         cru.checkdb(db)
         return db
 
-    def requests_session(self, pool_connections=5):
+    def requests_session(self, pool_connections=5, pool_maxsize=None):
+        p = {'pool_connections': pool_connections}
+        if pool_maxsize is not None:
+            p['pool_maxsize'] = pool_maxsize
         s = requests.Session()
-        s.mount('https://', requests.adapters.HTTPAdapter(
-            pool_connections=pool_connections))
+        s.mount('https://', requests.adapters.HTTPAdapter(**p))
+        if pool_maxsize is not None:
+            s.mount('http://', requests.adapters.HTTPAdapter(**p))
         return s
 
 
@@ -1,12 +1,18 @@
 #!./venv/bin/python
 import argparse
+import concurrent.futures
 import csv
 import math
 import sys
 import datetime
 import operator
 import functools
-import requests
+import heapq
+import itertools
+import json
+import sqlite3
+import threading
+import time
 
 cr_conf = __import__('cr-conf')
 cf = cr_conf.conf
@@ -15,6 +21,7 @@ ampm = False
 bland = not sys.stdout.isatty()
 main_slots = ('main_hand', 'dress', 'finger', 'neck')
 nostats = (0, 0, 0, 0, 0, 0)
+stats_memo_size = 4096
 
 
 def nothing(slot):
@@ -22,40 +29,45 @@ def nothing(slot):
     return 'nothing (%s)' % (slot,)
 
 
+@functools.lru_cache(maxsize=stats_memo_size)
 def derive_stats(level, base):
+    return calc_derived_stats(level, base)
+
+
+def calc_derived_stats(level, base, tanh=math.tanh, pow=math.pow):
     str, int, dex, wis, chr, luck = base
     level_3_sqrt = math.sqrt(level * 3)
     maxhp = (str * 2.9) + (int * 1.5) + (dex * 2.1) + (chr * 3.5)
     mindam = (str * 0.35) + (int * 0.45) + (dex * 0.4) + (wis * 0.5)
     maxdam = (str * 0.45) + (int * 0.65) + (dex * 0.55) + (wis * 0.55)
     # hit chance
-    hitc = math.pow(math.tanh(((int * 2) + (wis * 2)) / (level + 100)), 2) * \
+    hitc = pow(tanh(((int * 2) + (wis * 2)) / (level + 100)), 2) * \
         (level_3_sqrt + 35)
     # hit first
-    hitf = math.pow(math.tanh((dex * 4) / (level + 100)), 2) * \
+    hitf = pow(tanh((dex * 4) / (level + 100)), 2) * \
         (level_3_sqrt + 35)
     # crit damage multiplier
-    cdm = (math.pow(math.tanh(((int * 2.5) + (luck * 2.5)) / (level + 100)), 2) *
+    cdm = (pow(tanh(((int * 2.5) + (luck * 2.5)) / (level + 100)), 2) *
            ((level_3_sqrt / 100) + 0.4)) + \
-        (math.tanh(((int * 0.5) + (luck * 4)) / (level + 100)) *
+        (tanh(((int * 0.5) + (luck * 4)) / (level + 100)) *
          ((level_3_sqrt / 100) + 0.1))
     # melee crit
-    mc = (math.pow(math.tanh((int + (dex * 2) + (luck * 4)) /
-                             (level + 100)), 2) *
+    mc = (pow(tanh((int + (dex * 2) + (luck * 4)) /
+                   (level + 100)), 2) *
           (level_3_sqrt + 25)) + \
-        (math.tanh((luck * 4) / (level + 100)) * (level_3_sqrt + 10))
+        (tanh((luck * 4) / (level + 100)) * (level_3_sqrt + 10))
     # crit resist
-    cr = (math.pow(math.tanh(((str * 2) + chr) / (level + 100)), 2) *
+    cr = (pow(tanh(((str * 2) + chr) / (level + 100)), 2) *
           (level_3_sqrt + 40)) + \
-        (math.tanh(((str * 0.5) + (chr * 6)) / (level + 100)) *
+        (tanh(((str * 0.5) + (chr * 6)) / (level + 100)) *
          (level_3_sqrt + 10))
     # evade chance
-    ec = (math.pow(math.tanh(((dex * 3) + (luck * 2)) /
-                             (level + 100)), 2) * 40) + \
-        (math.tanh(((dex * 0.5) + (luck * 6)) / (level + 100)) * 10) + \
+    ec = (pow(tanh(((dex * 3) + (luck * 2)) /
+                   (level + 100)), 2) * 40) + \
+        (tanh(((dex * 0.5) + (luck * 6)) / (level + 100)) * 10) + \
         level_3_sqrt
     # melee resist
-    mr = math.pow(math.tanh(((str * 2) + (chr * 3)) / (level + 100)), 2) * \
+    mr = pow(tanh(((str * 2) + (chr * 3)) / (level + 100)), 2) * \
         (level_3_sqrt + 33)
     return (maxhp, mindam, maxdam, hitc, hitf, cdm, mc, cr, ec, mr)
 
@@ -118,42 +130,27 @@ def last_weekly_refresh(now):
     return target
 
 
-def get_raider_raids(cur, rid, last_daily, last_weekly):
-    cur.execute('''SELECT remaining, last_raid, last_endless
-        FROM raids WHERE raider = ?''', (rid,))
-    rows = tuple(cur.fetchall())
-    if len(rows) == 0:
-        return -1, -1
-    raids_left, last_raid, last_endless = rows[0]
-    if last_raid < cru.timestamp_utc(last_weekly):
+def calc_raider_raids(row, last_daily_secs, last_weekly_secs):
+    raids_left, last_raid, last_endless = row
+    if last_raid < last_weekly_secs:
         raids_left = cf.cr_weekly_raids
     if not last_endless:
         return raids_left, -1
-    endless_left = int(last_endless < cru.timestamp_utc(last_daily))
+    endless_left = int(last_endless < last_daily_secs)
     return raids_left, endless_left
 
 
-def get_raider_recruiting(cur, rid, now):
-    cur.execute('SELECT next, cost FROM recruiting WHERE raider = ?', (rid,))
-    rows = tuple(cur.fetchall())
-    if len(rows) == 0:
-        return -2, -1
-    next, cost = rows[0]
-    if next and next > cru.timestamp_utc(now):
+def calc_raider_recruiting(row, now_secs):
+    next, cost = row
+    if next and next > now_secs:
         return next, cost
     else:
         return 0, cost
 
 
-def get_raider_questing(cur, rid, now):
-    cur.execute('''SELECT status, started_on, return_divisor, reward_time,
-        returns_on FROM quests WHERE raider = ?''', (rid,))
-    rows = tuple(cur.fetchall())
-    if len(rows) == 0:
-        return '?', -1
-    status, started_on, return_div, reward_secs, returns_on = rows[0]
+def calc_raider_questing(row, now_secs):
+    status, started_on, return_div, reward_secs, returns_on = row
     is_returning = cf.quest_returning[status]
-    now_secs = cru.timestamp_utc(now)
 
     if is_returning is None:
         status_str = 'no'
@@ -257,17 +254,30 @@ class RaiderListReport(TabularReport):
 
     def fetch(self, db):
         cur = db.cursor()
-        cur.execute('SELECT id, name, level, generation, race FROM raiders')
+        cur.execute('''SELECT r.id, r.name, r.level, r.generation, r.race,
+            d.raider, d.remaining, d.last_raid, d.last_endless,
+            c.raider, c.next, c.cost,
+            q.raider, q.status, q.started_on, q.return_divisor,
+            q.reward_time, q.returns_on
+            FROM raiders r
+            LEFT JOIN raids d ON d.raider = r.id
+            LEFT JOIN recruiting c ON c.raider = r.id
+            LEFT JOIN quests q ON q.raider = r.id''')
         rows = tuple(cur.fetchall())
         now = datetime.datetime.utcnow()
-        last_daily = last_daily_refresh(now)
-        last_weekly = last_weekly_refresh(now)
+        now_secs = cru.timestamp_utc(now)
+        last_daily_secs = cru.timestamp_utc(last_daily_refresh(now))
+        last_weekly_secs = cru.timestamp_utc(last_weekly_refresh(now))
 
-        for id, name, lvl, gen, race in rows:
+        for row in rows:
+            id, name, lvl, gen, race = row[:5]
             lvl_name = '[%d] %s' % (lvl, name)
-            raids, endless = get_raider_raids(cur, id, last_daily, last_weekly)
-            recruit_time, recruit_cost = get_raider_recruiting(cur, id, now)
-            quest_status, quest_back = get_raider_questing(cur, id, now)
+            raids, endless = (-1, -1) if row[5] is None else \
+                calc_raider_raids(row[6:9], last_daily_secs, last_weekly_secs)
+            recruit_time, recruit_cost = (-2, -1) if row[9] is None else \
+                calc_raider_recruiting(row[10:12], now_secs)
+            quest_status, quest_back = ('?', -1) if row[12] is None else \
+                calc_raider_questing(row[13:18], now_secs)
             yield (id, lvl_name, gen, race, raids, endless,
                    recruit_time, recruit_cost,
                    quest_status, quest_back)
@@ -337,6 +347,11 @@ def get_equipped(cur, rid):
 
 
 def skew_stats(stats):
+    return skew_stats_tuple(tuple(stats))
+
+
+@functools.lru_cache(maxsize=stats_memo_size)
+def skew_stats_tuple(stats):
     stats = tuple(map(float, stats))
     s = sorted(enumerate(stats[:3]), key=lambda i: i[1])
     s = ((i[0], i[1] * j) for i, j in zip(s, (0.05, 0.7, 1.0)))
@@ -344,6 +359,95 @@ def skew_stats(stats):
     return tuple(s) + stats[3:]
 
 
+def skew_stats_array(stats):
+    import numpy
+    stats = numpy.asarray(stats, dtype=float)
+    # same as skew_stats, applied to each row of an (N, 6) array
+    order = numpy.argsort(stats[:, :3], axis=1, kind='stable')
+    factors = numpy.empty_like(stats[:, :3])
+    numpy.put_along_axis(factors, order, numpy.array([[0.05, 0.7, 1.0]]),
+                         axis=1)
+    return numpy.column_stack((stats[:, :3] * factors, stats[:, 3:]))
+
+
+def combo_stats_array(level, base, slot_stats):
+    import numpy
+    # broadcast-sum one stats matrix per slot into the cartesian product of
+    # all slots, in the same order as nested loops over slot_stats would be
+    raw = numpy.asarray(base, dtype=float)
+    for idx, stats in enumerate(slot_stats):
+        shape = [1] * len(slot_stats) + [len(cf.stat_names)]
+        shape[idx] = -1
+        raw = raw + numpy.asarray(stats, dtype=float).reshape(shape)
+    skewed = skew_stats_array(raw.reshape(-1, len(cf.stat_names)))
+    derived = calc_derived_stats(level, skewed.T,
+                                 tanh=numpy.tanh, pow=numpy.power)
+    return numpy.column_stack(tuple(skewed.T) + derived + (sum(derived),))
+
+
+def combo_stats_bounds(level, upper):
+    import numpy
+    # Upper bounds on each combo_stats_array column for any raw stats that
+    # are non-negative and no greater than a row of upper. Skewing scales
+    # each of the first three stats by at most 1.0 and the derived stats
+    # grow with the skewed ones, so trying every way skew_stats could
+    # assign its factors covers whichever one a combo ends up with.
+    upper = numpy.asarray(upper, dtype=float)
+    factors = numpy.array(tuple(itertools.permutations((0.05, 0.7, 1.0))))
+    skewed = numpy.repeat(upper[:, None, :], len(factors), axis=1)
+    skewed[:, :, :3] *= factors
+    derived = calc_derived_stats(level,
+                                 skewed.reshape(-1, upper.shape[1]).T,
+                                 tanh=numpy.tanh, pow=numpy.power)
+    derived = numpy.column_stack(derived + (sum(derived),))
+    derived = derived.reshape(len(upper), len(factors), -1).max(axis=1)
+    return numpy.column_stack((upper, derived))
+
+
+def sort_combos(stats_all, key_cols):
+    import numpy
+    # descending by key, ascending by position for equal keys
+    keys = tuple(stats_all[:, i] for i in reversed(key_cols))
+    return numpy.lexsort((-numpy.arange(len(stats_all)),) + keys)[::-1]
+
+
+def prune_dominated_gear(base, gear, count):
+    # Drop items for which at least count other items in the same slot are
+    # at least as good in every stat, as those can't be in the top count
+    # combos. skew_stats makes the derived stats non-monotone where the
+    # ranking of strength/intelligence/agility can change, so any of those
+    # whose range over all combos overlaps another must match exactly.
+    if count <= 0:
+        return gear, 0
+    lows = list(base)
+    highs = list(base)
+    for rows in gear.values():
+        for i in range(len(base)):
+            lows[i] += min(row[1+i] for row in rows)
+            highs[i] += max(row[1+i] for row in rows)
+    if min(lows) < 0:
+        return gear, 0
+    exact = tuple(i for i in range(3) if any(
+        lows[i] <= highs[j] and lows[j] <= highs[i]
+        for j in range(3) if j != i))
+
+    pruned = 0
+    kept = {}
+    for slot, rows in gear.items():
+        kept[slot] = []
+        for row in rows:
+            stats = row[1:]
+            dominators = sum(1 for other in rows
+                             if other[1:] != stats and
+                             all(o >= s for o, s in zip(other[1:], stats)) and
+                             all(other[1+i] == stats[i] for i in exact))
+            if dominators >= count:
+                pruned += 1
+            else:
+                kept[slot].append(row)
+    return kept, pruned
+
+
 def remove_dups(items):
     dups = {}
     for i in items:
@@ -373,12 +477,20 @@ class RaiderComboReport(TabularReport):
             ('evade', 'Evade', 'float_1', True),
             ('damgrst', 'DamResist', 'float_1', True),
             ('total', 'Total', 'float_1', True)))
-
-    def fetch(self, db, rid, sort_total=False):
-        _, combos = self.fetch_more(db, rid, sort_total=sort_total)
+        self.pruned = 0
+        self.nodes_visited = 0
+        self.nodes_total = 0
+
+    def fetch(self, db, rid, sort_total=False, count=None, prune=True,
+              optimize=False):
+        _, combos = self.fetch_more(db, rid, sort_total=sort_total,
+                                    count=count, prune=prune,
+                                    optimize=optimize)
         return combos
 
-    def fetch_more(self, db, rid, sort_total=False):
+    def fetch_more(self, db, rid, sort_total=False, count=None, prune=True,
+                   optimize=False):
+        import numpy
         cur = db.cursor()
         slot_names, slot_stats = get_raider_slots(cur, rid)
         level = slot_names[None][0]
@@ -399,45 +511,121 @@ class RaiderComboReport(TabularReport):
             gear[slot] = list(remove_dups(cur.fetchall()))
             if len(gear[slot]) == 0:
                 gear[slot].append((nothing(slot),) + nostats)
-        combos = []
-        for weap_row in gear['main_hand']:
-            weap_stats = weap_row[1:]
-            for dress_row in gear['dress']:
-                dress_stats = dress_row[1:]
-                for ring_row in gear['finger']:
-                    ring_stats = ring_row[1:]
-                    for neck_row in gear['neck']:
-                        neck_stats = neck_row[1:]
-                        new_raw_stats = map(sum, zip(
-                            slot_stats[None], weap_stats, dress_stats,
-                            ring_stats, neck_stats))
-                        new_raw_stats = tuple(new_raw_stats)
-                        new_skewed_stats = skew_stats(new_raw_stats)
-                        new_derived_stats = derive_stats(
-                            level, new_skewed_stats)
-                        new_stats_all = (new_skewed_stats + new_derived_stats +
-                                         (sum(new_derived_stats),))
-                        stats_diff = tuple(n - c for n, c in
-                                           zip(new_stats_all, cur_stats_all))
-                        combo_row = ('',) + new_stats_all
-                        diff_row = ('',) + stats_diff
-                        combos.append((combo_row, diff_row, weap_row,
-                                       dress_row, ring_row, neck_row))
-
+        self.pruned = 0
+        if prune and count is not None:
+            gear, self.pruned = prune_dominated_gear(
+                slot_stats[None], gear, count)
+
+        shape = tuple(len(gear[slot]) for slot in main_slots)
+        gear_stats = tuple(tuple(row[1:] for row in gear[slot])
+                           for slot in main_slots)
         max_stat_idx, _ = max(enumerate(slot_stats[None]), key=lambda i: i[1])
         if sort_total:
-            combos.sort(key=lambda i: (i[0][-1], i[0][1+max_stat_idx]),
-                        reverse=True)
+            key_cols = (-1, max_stat_idx)
         else:
-            combos.sort(key=lambda i: (i[0][1+max_stat_idx], i[0][-1]),
-                        reverse=True)
+            key_cols = (max_stat_idx, -1)
+
+        if count is None:
+            stats_all = combo_stats_array(level, slot_stats[None], gear_stats)
+            order = sort_combos(stats_all, key_cols)
+            sorted_stats = stats_all[order]
+        else:
+            select = self._bound_combos if optimize else self._top_combos
+            order, sorted_stats = select(
+                level, slot_stats[None], gear_stats, key_cols, count)
+            order = numpy.array(order, dtype=int)
+            sorted_stats = numpy.array(sorted_stats, dtype=float).reshape(
+                len(order), len(cur_stats_all))
+
+        combos = []
+        for new_stats_all, stats_diff, *row_idx in zip(
+                sorted_stats.tolist(),
+                (sorted_stats - cur_stats_all).tolist(),
+                *(i.tolist() for i in numpy.unravel_index(order, shape))):
+            combo_row = ('',) + tuple(new_stats_all)
+            diff_row = ('',) + tuple(stats_diff)
+            combos.append((combo_row, diff_row) + tuple(
+                gear[slot][i] for slot, i in zip(main_slots, row_idx)))
         return set(equipped.values()), combos
 
+    def _push_top(self, heap, count, key_cols, stats_all, first_pos):
+        order = sort_combos(stats_all, key_cols)[:count]
+        for idx, row in zip(order.tolist(), stats_all[order].tolist()):
+            item = (row[key_cols[0]], row[key_cols[1]],
+                    -(first_pos + idx), row)
+            if len(heap) < count:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+            else:
+                # the rest of this chunk sorts after this combo
+                break
 
-def calc_best_gear(db, rid, count, url, mobs, sort_total=False):
+    def _top_combos(self, level, base, gear_stats, key_cols, count):
+        # keep only the best count combos in a min-heap, computing the
+        # combos for one item of the first slot at a time
+        heap = []
+        if count <= 0:
+            return [], []
+        chunk_len = functools.reduce(operator.mul, map(len, gear_stats[1:]))
+        for first_idx, first_stats in enumerate(gear_stats[0]):
+            stats_all = combo_stats_array(
+                level, base, ((first_stats,),) + gear_stats[1:])
+            self._push_top(heap, count, key_cols, stats_all,
+                           first_idx * chunk_len)
+        heap.sort(reverse=True)
+        return [-i[2] for i in heap], [i[3] for i in heap]
+
+    def _bound_combos(self, level, base, gear_stats, key_cols, count):
+        import numpy
+        self.nodes_visited = 0
+        self.nodes_total = 0
+        if count <= 0:
+            return [], []
+        # Branch and bound over all but the last slot, which is evaluated
+        # as one chunk at the leaves. A subtree is skipped when the bound on
+        # its best possible sort key is below the worst combo kept so far.
+        slots = tuple(numpy.array(i, dtype=float) for i in gear_stats)
+        sizes = tuple(map(len, slots))
+        base = numpy.asarray(base, dtype=float)
+        self.nodes_total = sum(functools.reduce(operator.mul, sizes[:i], 1)
+                               for i in range(len(sizes)))
+        if (base + sum(i.min(axis=0) for i in slots)).min() < 0:
+            # the bounds don't hold for negative stats
+            return self._top_combos(level, base, gear_stats, key_cols, count)
+        heap = []
+        rest_max = [sum(i.max(axis=0) for i in slots[depth:])
+                    for depth in range(1, len(slots))] + [0]
+
+        def visit(depth, partial, pos):
+            self.nodes_visited += 1
+            if depth == len(slots) - 1:
+                stats_all = combo_stats_array(level, partial, (slots[-1],))
+                self._push_top(heap, count, key_cols, stats_all,
+                               pos * sizes[-1])
+                return
+            children = partial + slots[depth]
+            bounds = combo_stats_bounds(level, children + rest_max[depth])
+            bounds = tuple(zip(bounds[:, key_cols[0]].tolist(),
+                               bounds[:, key_cols[1]].tolist()))
+            for idx in sorted(range(len(children)), key=lambda i: bounds[i],
+                              reverse=True):
+                if len(heap) == count and bounds[idx] < heap[0][:2]:
+                    break
+                visit(depth + 1, children[idx], pos * sizes[depth] + idx)
+
+        visit(0, base, 0)
+        heap.sort(reverse=True)
+        return [-i[2] for i in heap], [i[3] for i in heap]
+
+
+def calc_best_gear(db, rid, count, url, mobs, sort_total=False,
+                   prune=True, optimize=False, concurrency=1, cache=None,
+                   tolerance=None):
     mobs = tuple(mobs)
     report = RaiderComboReport()
-    sim = FightSimReport(url)
+    sim = FightSimReport(url, concurrency=concurrency, cache=cache,
+                         tolerance=tolerance)
     cur = db.cursor()
     slot_names, slot_stats = get_raider_slots(cur, rid, fill=True)
     lvl = slot_names[None][0]
@@ -453,7 +641,22 @@ def calc_best_gear(db, rid, count, url, mobs, sort_total=False):
     cur_eff_stats = skew_stats(raw_stats)
     cur_der_stats = derive_stats(lvl, cur_eff_stats)
 
-    combos = list(report.fetch(db, rid, sort_total=sort_total))
+    combos = list(report.fetch(db, rid, sort_total=sort_total, count=count,
+                               prune=prune, optimize=optimize))
+    if report.pruned:
+        print('Skipped %d dominated gear item(s)' % (report.pruned,))
+    if optimize:
+        print('Searched %d of %d gear combo nodes' % (
+            report.nodes_visited, report.nodes_total))
+
+    rune = slot_names.get('knickknack')
+    fighters = [sim.raider_fighter(cur, rid)]
+    fighters.extend(sim.custom_gear_fighter(
+        cur, rid, dict(zip(main_slots, c[2:])), knickknack=rune)
+                    for c in combos[:count])
+    results = sim.fetch_many([(f, m) for f in fighters for m in mobs])
+    win_rates = [[r[2] for r in results[i*len(mobs):(i+1)*len(mobs)]]
+                 for i in range(len(fighters))]
 
     def fmtstats(s):
         return ' '.join('%7d' % i for i in s)
@@ -462,9 +665,8 @@ def calc_best_gear(db, rid, count, url, mobs, sort_total=False):
                             fmt_hdr(report.columns[1:], 7),
                             ' '.join(' %*s' % (moblen, m) for m in mobs)))
     cur_stats_line = cur_eff_stats + cur_der_stats + (sum(cur_der_stats),)
-    wins = ' '.join(fmt_percentage(sim.fetch_one(cur, rid, m)[2],
-                                   moblen, bold=True)
-                    for m in mobs)
+    wins = ' '.join(fmt_percentage(w, moblen, bold=True)
+                    for w in win_rates[0])
     print(fmt_base(('%-*s  %s\n' * 5 + '%-*s  %s  %s\n') % (
         namelen, id_lvl_name, fmtstats(slot_stats[None]),
         namelen, slot_names['main_hand'], fmtstats(slot_stats['main_hand']),
@@ -473,14 +675,13 @@ def calc_best_gear(db, rid, count, url, mobs, sort_total=False):
         namelen, slot_names['neck'], fmtstats(slot_stats['neck']),
         namelen, '', fmtstats(cur_stats_line), wins)))
 
-    for combo_row, diff_row, weap_row, dress_row, ring_row, neck_row in combos[:count]:
+    for combo_idx, combo in enumerate(combos[:count], 1):
+        combo_row, diff_row, weap_row, dress_row, ring_row, neck_row = combo
         cur_equipment = True
-        gear_combo = {}
         for slot, row in (('main_hand', weap_row),
                           ('dress', dress_row),
                           ('finger', ring_row),
                           ('neck', neck_row)):
-            gear_combo[slot] = row
             stats = '%-*s  %s' % (
                 namelen, row[0], fmtstats(row[1:]))
             if slot in slot_names and slot_names[slot] == row[0] and \
@@ -490,11 +691,8 @@ def calc_best_gear(db, rid, count, url, mobs, sort_total=False):
                 cur_equipment = False
                 print(stats)
 
-        rune = slot_names.get('knickknack')
-        wins = ' '.join(fmt_percentage(sim.fetch_custom_gear(
-            cur, rid, gear_combo, m, knickknack=rune)[2],
-                                       moblen, bold=cur_equipment)
-                        for m in mobs)
+        wins = ' '.join(fmt_percentage(w, moblen, bold=cur_equipment)
+                        for w in win_rates[combo_idx])
 
         if cur_equipment:
             print('%-*s  %s  %s\n' % (
@@ -586,6 +784,14 @@ def show_raider(db, rid):
             namelen, row[0], ' '.join(fmt_stat_diff(i, 7) for i in row[1:])))
 
 
+def print_memo_stats():
+    for name, func in (('skew_stats', skew_stats_tuple),
+                       ('derive_stats', derive_stats)):
+        info = func.cache_info()
+        print('%s memo: %d hits, %d misses, %d/%d cached' % (
+            name, info.hits, info.misses, info.currsize, info.maxsize))
+
+
 def fmt_stat_diff(stat, width):
     color = None
     if stat > 0.005:
@@ -597,13 +803,18 @@ def fmt_stat_diff(stat, width):
     return '\033[0;%dm%+*.1f\033[0m' % (color, width, stat)
 
 
-def fmt_percentage(num, width=0, bold=False):
+def percentage_band(num):
     if num > 95:
-        color = 36  # cyan
+        return 2
     elif num > 70:
-        color = 33  # yellow
+        return 1
     else:
-        color = 35  # magenta
+        return 0
+
+
+def fmt_percentage(num, width=0, bold=False):
+    # magenta, yellow, cyan
+    color = (35, 33, 36)[percentage_band(num)]
     if bland:
         return '%*.0f%%' % (width, num,)
     boldstr = ';1' if bold else ''
@@ -646,6 +857,48 @@ def findraider(db, ident):
     return tuple(ids), trusted
 
 
+class SimCache():
+    def __init__(self, path, max_entries=100000):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        cur = self._db.cursor()
+        # losing the last few results in a crash is fine for a cache
+        cur.execute('PRAGMA synchronous = OFF')
+        cur.execute('''CREATE TABLE IF NOT EXISTS sims(
+            params TEXT PRIMARY KEY,
+            result TEXT,
+            used INTEGER)''')
+        cur.execute('CREATE INDEX IF NOT EXISTS sims__used ON sims(used)')
+        cur.execute('''DELETE FROM sims WHERE params IN (
+            SELECT params FROM sims ORDER BY used DESC LIMIT -1 OFFSET ?)''',
+                    (max_entries,))
+        self._db.commit()
+
+    def _key(self, params):
+        return json.dumps(params, sort_keys=True)
+
+    def get(self, params):
+        key = self._key(params)
+        with self._lock:
+            cur = self._db.cursor()
+            cur.execute('SELECT result FROM sims WHERE params = ?', (key,))
+            row = cur.fetchone()
+            if row is None:
+                return
+            cur.execute('UPDATE sims SET used = ? WHERE params = ?',
+                        (int(time.time()), key))
+            self._db.commit()
+        return json.loads(row[0])
+
+    def put(self, params, data):
+        with self._lock:
+            self._db.execute('''INSERT OR REPLACE INTO sims
+                (params, result, used) VALUES (?, ?, ?)''',
+                             (self._key(params), json.dumps(data),
+                              int(time.time())))
+            self._db.commit()
+
+
 class FightSimReport(TabularReport):
     mobs = ('hogger', 'hoggerHeroic', 'faune', 'fauneHeroic',
             'rat', 'ratHeroic', 'krok', 'krokHeroic',
@@ -654,8 +907,10 @@ class FightSimReport(TabularReport):
             'shaacov', 'shaacovHeroic')
     stat_names = ('strength', 'intelligence', 'agility',
                   'wisdom', 'charm', 'luck')
+    adaptive_batch = 100
 
-    def __init__(self, url=cf.default_sim_url):
+    def __init__(self, url=cf.default_sim_url, concurrency=1, cache=None,
+                 tolerance=None):
         super().__init__((
             ('raider', 'Raider', 'str', False),
             ('mob', 'Mob', 'str', False),
@@ -665,31 +920,89 @@ class FightSimReport(TabularReport):
             ('mobdam', 'Mob Damg', 'float_1', True),
             ('moblife', 'Mob Life', 'float_1', True)))
         self.url = url.rstrip('/') + '/mfight'
+        self.concurrency = max(1, concurrency)
+        self.cache = cache
+        self.tolerance = tolerance
+        self.latencies = []
+        self.fights = 0
+        self._stats_lock = threading.Lock()
+        self.session = cf.requests_session(
+            pool_connections=1, pool_maxsize=self.concurrency)
 
     def rune_name(self, name):
         tail = ' - Spell Rune'
         assert name.endswith(tail), (name, tail)
         return name[:-len(tail)]
 
-    def fetch_custom_gear(self, cur, raider_id, gear, mob_name,
-                          knickknack=None, count=1000):
+    def custom_gear_fighter(self, cur, raider_id, gear, knickknack=None):
         level, name, base_stats = get_raider_info(cur, raider_id)
         allstats = (base_stats,) + tuple(g[1:] for g in gear.values())
         combostats = tuple(map(sum, zip(*allstats)))
-        return self.fetch_raw(level, name, combostats, mob_name,
-                              knickknack=knickknack, count=count)
+        return level, name, combostats, knickknack
 
-    def fetch_one(self, cur, raider_id, mob_name, count=1000):
+    def raider_fighter(self, cur, raider_id):
         names, stats = get_raider_slots(cur, raider_id)
         assert stats is not None
         rune = names.get('knickknack')
         rlevel, rname = names[None]
         rstats = tuple(map(sum, zip(*stats.values())))
-
-        return self.fetch_raw(rlevel, rname, rstats, mob_name,
-                              knickknack=rune, count=count)
-
-    def fetch_raw(self, level, name, stats, mob_name, knickknack, count):
+        return rlevel, rname, rstats, rune
+
+    def fetch_many(self, jobs, count=1000):
+        # jobs are (fighter, mob_name) pairs, with fighters as returned by
+        # raider_fighter or custom_gear_fighter; results keep job order
+        def fetch_job(job):
+            (level, name, stats, rune), mob_name = job
+            return self.fetch_raw(level, name, stats, mob_name,
+                                  knickknack=rune, count=count)
+
+        if self.concurrency == 1:
+            return [fetch_job(i) for i in jobs]
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency) as pool:
+            return list(pool.map(fetch_job, jobs))
+
+    def fetch_many_async(self, jobs, count=1000, completed=None):
+        # like fetch_many, but also calls completed(job_index, result) as
+        # each simulation finishes
+        import asyncio
+        import aiohttp
+
+        async def post_sim(session, semaphore, params):
+            async with semaphore:
+                started = time.monotonic()
+                async with session.post(self.url, json=params) as r:
+                    data = await r.json()
+                self.count_sim(params, started)
+            return data
+
+        async def fetch_job(session, semaphore, idx, job):
+            (level, name, stats, rune), mob_name = job
+            params = self.sim_params(level, stats, mob_name, rune, count)
+            batches = self.sim_batches(params)
+            try:
+                batch = next(batches)
+                while True:
+                    batch = batches.send(
+                        await post_sim(session, semaphore, batch))
+            except StopIteration as stop:
+                data = stop.value
+            res = self.sim_result(level, name, mob_name, data)
+            if completed is not None:
+                completed(idx, res)
+            return res
+
+        async def fetch_all():
+            semaphore = asyncio.Semaphore(self.concurrency)
+            conn = aiohttp.TCPConnector(limit=self.concurrency)
+            async with aiohttp.ClientSession(connector=conn) as session:
+                return await asyncio.gather(*(
+                    fetch_job(session, semaphore, idx, job)
+                    for idx, job in enumerate(jobs)))
+
+        return asyncio.run(fetch_all())
+
+    def sim_params(self, level, stats, mob_name, knickknack, count):
         stats_map = dict(zip(self.stat_names, stats))
         params = {'simCount': count,
                   'fighterA': {'level': level, 'stats': stats_map},
@@ -697,10 +1010,59 @@ class FightSimReport(TabularReport):
         if knickknack is not None:
             params['fighterA']['knickknack'] = {
                 'name': self.rune_name(knickknack)}
-        r = requests.post(self.url, json=params)
-        data = r.json()
-
-        sim_count = data['fighterAWinCount'] + data['fighterBWinCount']
+        return params
+
+    def cache_key(self, params):
+        # results from another simulator must not be reused
+        key = dict(params, url=self.url)
+        if self.tolerance is not None:
+            key['adaptiveTolerance'] = self.tolerance
+        return key
+
+    def sim_count(self, data):
+        return data['fighterAWinCount'] + data['fighterBWinCount']
+
+    def next_batch(self, params, data):
+        if self.tolerance is None:
+            return params
+        done = 0 if data is None else self.sim_count(data)
+        batch = max(done, self.adaptive_batch)
+        return dict(params, simCount=min(batch, params['simCount'] - done))
+
+    def sim_settled(self, params, data):
+        # With a tolerance, simulations stop once the 95% confidence
+        # interval of the win rate is narrow enough, or when it falls
+        # entirely within one of the fmt_percentage color bands.
+        sims = self.sim_count(data)
+        if self.tolerance is None or not sims or sims >= params['simCount']:
+            return True
+        z = 1.96
+        rate = data['fighterAWinCount'] / sims
+        center = (rate + z * z / (2 * sims)) / (1 + z * z / sims)
+        spread = z * math.sqrt(rate * (1 - rate) / sims +
+                               z * z / (4 * sims * sims)) / (1 + z * z / sims)
+        low = (center - spread) * 100
+        high = (center + spread) * 100
+        return spread * 100 <= self.tolerance or \
+            percentage_band(low) == percentage_band(high)
+
+    def merge_sims(self, old, new):
+        old_count = self.sim_count(old)
+        new_count = self.sim_count(new)
+        total = old_count + new_count
+        merged = {'fighterAWinCount': (old['fighterAWinCount'] +
+                                       new['fighterAWinCount']),
+                  'fighterBWinCount': (old['fighterBWinCount'] +
+                                       new['fighterBWinCount'])}
+        for fighter in ('fighterAAverage', 'fighterBAverage'):
+            merged[fighter] = {
+                k: (old[fighter][k] * old_count +
+                    new[fighter][k] * new_count) / total
+                for k in ('damagePerSim', 'remainingLife')}
+        return merged
+
+    def sim_result(self, level, name, mob_name, data):
+        sim_count = self.sim_count(data)
         if sim_count == 0:
             return
         win_rate = data['fighterAWinCount'] / sim_count * 100
@@ -710,9 +1072,52 @@ class FightSimReport(TabularReport):
                 data['fighterBAverage']['damagePerSim'],
                 data['fighterBAverage']['remainingLife'])
 
+    def sim_batches(self, params):
+        # generator for one simulation, shared by the sync and async paths:
+        # it yields the params for each request to make, is sent back the
+        # response, and returns the merged result. a cached result needs no
+        # requests at all
+        key = self.cache_key(params)
+        data = self.cache.get(key) if self.cache else None
+        if data is None:
+            data = yield self.next_batch(params, None)
+            while not self.sim_settled(params, data):
+                more = yield self.next_batch(params, data)
+                if not self.sim_count(more):
+                    break
+                data = self.merge_sims(data, more)
+            if self.cache:
+                self.cache.put(key, data)
+        return data
+
+    def count_sim(self, params, started):
+        with self._stats_lock:
+            self.latencies.append(time.monotonic() - started)
+            self.fights += params['simCount']
+
+    def post_sim(self, params):
+        started = time.monotonic()
+        r = self.session.post(self.url, json=params)
+        data = r.json()
+        self.count_sim(params, started)
+        return data
 
-def call_fight_simulator(url, db, ids, mobs, count=1000):
-    report = FightSimReport(url)
+    def fetch_raw(self, level, name, stats, mob_name, knickknack, count):
+        params = self.sim_params(level, stats, mob_name, knickknack, count)
+        batches = self.sim_batches(params)
+        try:
+            batch = next(batches)
+            while True:
+                batch = batches.send(self.post_sim(batch))
+        except StopIteration as stop:
+            data = stop.value
+        return self.sim_result(level, name, mob_name, data)
+
+
+def call_fight_simulator(url, db, ids, mobs, count=1000, concurrency=1,
+                         cache=None, use_async=False, tolerance=None):
+    report = FightSimReport(url, concurrency=concurrency, cache=cache,
+                            tolerance=tolerance)
     fmt = {
         'str': str,
         'percent': lambda v: fmt_percentage(v, 4),
@@ -727,16 +1132,43 @@ def call_fight_simulator(url, db, ids, mobs, count=1000):
     widths = [len(i) for i in report.labels]
     widths[0] = max(widths[0], namelen + 4)
     widths[1] = max(widths[1], moblen)
-    print(' '.join(('%*s' if report.right_align[i] else '%-*s') % (
-        widths[i], report.labels[i])
-                   for i in range(report.colcount)))
+
+    def print_row(row):
+        str_row = [fmt[report.coltypes[i]](v) for i, v in enumerate(row)]
+        print(' '.join(('%*s' if report.right_align[i] else '%-*s') % (
+            widths[i], str_row[i])
+                       for i in range(report.colcount)))
+
+    header = ' '.join(('%*s' if report.right_align[i] else '%-*s') % (
+        widths[i], report.labels[i]) for i in range(report.colcount))
+    print(header)
+    jobs = []
     for rid in ids:
-        for mob_name in mobs:
-            row = report.fetch_one(curs, rid, mob_name, count)
-            str_row = [fmt[report.coltypes[i]](v) for i, v in enumerate(row)]
-            print(' '.join(('%*s' if report.right_align[i] else '%-*s') % (
-                widths[i], str_row[i])
-                           for i in range(report.colcount)))
+        fighter = report.raider_fighter(curs, rid)
+        jobs.extend((fighter, mob_name) for mob_name in mobs)
+    if not use_async:
+        for row in report.fetch_many(jobs, count):
+            print_row(row)
+        if tolerance is not None:
+            print('\nSimulated %d of up to %d fights' % (
+                report.fights, count * len(jobs)))
+        return
+
+    rows = report.fetch_many_async(jobs, count,
+                                   completed=lambda idx, row: print_row(row))
+    print()
+    print(header)
+    for row in rows:
+        print_row(row)
+    if tolerance is not None:
+        print('\nSimulated %d of up to %d fights' % (
+            report.fights, count * len(jobs)))
+    lat = sorted(report.latencies)
+    if lat:
+        print('\n%d simulation(s) at concurrency %d, latency min %.3fs, '
+              'median %.3fs, 90%% %.3fs, max %.3fs' % (
+                  len(lat), report.concurrency, lat[0], lat[len(lat) // 2],
+                  lat[int(len(lat) * 0.9)], lat[-1]))
 
 
 def groupby_timespan(times, mins=30):
@@ -819,34 +1251,52 @@ class QuestReport(TabularReport):
         self.col_sep.append('')
 
     def fetch(self, db, ids, realname=False):
+        import numpy
         cur = db.cursor()
+        cur.execute('''CREATE TEMP TABLE IF NOT EXISTS report_ids(
+            id INTEGER PRIMARY KEY)''')
+        cur.execute('DELETE FROM report_ids')
+        cur.executemany('INSERT OR IGNORE INTO report_ids (id) VALUES (?)',
+                        ((i,) for i in ids))
+        db.commit()
 
         cur.execute('''SELECT r.id, r.level, r.name, q.contract, q.started_on,
-            q.return_divisor, q.reward_time FROM raiders r, quests q
-            WHERE r.id = q.raider AND q.status = 1 ORDER BY r.id''')
-        ids = set(ids)
+            q.return_divisor, q.reward_time,
+            d.raider, d.remaining, d.last_raid, d.last_endless
+            FROM raiders r
+            JOIN report_ids i ON i.id = r.id
+            JOIN quests q ON q.raider = r.id
+            LEFT JOIN raids d ON d.raider = r.id
+            WHERE q.status = 1 ORDER BY r.id''')
+        rows = list(cur.fetchall())
         now = datetime.datetime.utcnow()
         now_secs = cru.timestamp_utc(now)
-        last_daily = last_daily_refresh(now)
-        last_weekly = last_weekly_refresh(now)
-        rows = list(cur.fetchall())
-        for rid, level, name, addr, started, retdiv, reward in rows:
-            if rid not in ids:
-                continue
-            raids, endl = get_raider_raids(cur, rid, last_daily, last_weekly)
+        last_daily_secs = cru.timestamp_utc(last_daily_refresh(now))
+        last_weekly_secs = cru.timestamp_utc(last_weekly_refresh(now))
+
+        # reward and home times for every raider and reward cycle at once
+        started, retdiv, reward = (numpy.array([r[i] for r in rows],
+                                               dtype=numpy.int64)
+                                   for i in (4, 5, 6))
+        cycles = numpy.arange(self._first_reward - 1, self._last_reward)
+        next = now_secs + (reward - ((now_secs - started) % reward))
+        next = next[:, None] + cycles[None, :] * reward[:, None]
+        home = next + ((next - started[:, None]) / retdiv[:, None])
+
+        for row, row_next, row_home in zip(rows, next.tolist(),
+                                           home.tolist()):
+            rid, level, name, addr, started, retdiv, reward = row[:7]
+            raids, endl = (-1, -1) if row[7] is None else \
+                calc_raider_raids(row[8:11], last_daily_secs,
+                                  last_weekly_secs)
             ret = [rid,
                    (name if realname else '[%d] %s' % (level, name)),
                    raids,
                    cf.get_quest_name(address=addr, short=True),
                    reward,
                    started]
-
-            next = now_secs + (reward - ((now_secs - started) % reward))
-            next += (self._first_reward - 1) * reward
-            for _ in range(self._last_reward - self._first_reward + 1):
-                home = next + ((next - started) / retdiv)
-                ret.extend((next, home))
-                next += reward
+            for times in zip(row_next, row_home):
+                ret.extend(times)
             yield ret
 
 
@@ -933,6 +1383,23 @@ def main():
     p_best.add_argument('-t', dest='totalsort',
                         default=False, action='store_true',
                         help='Sort results by total score rather than minmax')
+    p_best.add_argument('-P', dest='prune',
+                        default=True, action='store_false',
+                        help='Do not skip gear that other gear outclasses')
+    p_best.add_argument('-b', dest='optimize',
+                        default=False, action='store_true',
+                        help='Search gear combos using branch and bound')
+    p_best.add_argument('-j', dest='concurrency', type=int, default=4,
+                        help='Number of fight simulations to run at once')
+    p_best.add_argument('-A', dest='tolerance', type=float,
+                        help='Stop fight simulations early once the win '
+                        'rate is known to within this many percent')
+    p_best.add_argument('--no-sim-cache', dest='simcache',
+                        default=True, action='store_false',
+                        help='Do not use or save cached fight simulations')
+    p_best.add_argument('--stats', dest='memostats',
+                        default=False, action='store_true',
+                        help='Show stat calculation memo hits and misses')
     # XXX add -s option for best
 
     p_gear = subparsers.add_parser('gear',
@@ -941,6 +1408,9 @@ def main():
     p_gear.add_argument('-u', dest='update',
                         default=False, action='store_true',
                         help='Update raider data first')
+    p_gear.add_argument('--stats', dest='memostats',
+                        default=False, action='store_true',
+                        help='Show stat calculation memo hits and misses')
     # XXX add -s option for gear
 
     p_list = subparsers.add_parser('list',
@@ -958,6 +1428,17 @@ def main():
     p_sim.add_argument('-c', dest='count',
                        type=int, default=1000,
                        help='Count of fights to simulate')
+    p_sim.add_argument('-j', dest='concurrency', type=int, default=4,
+                       help='Number of fight simulations to run at once')
+    p_sim.add_argument('-A', dest='tolerance', type=float,
+                       help='Stop fight simulations early once the win '
+                       'rate is known to within this many percent')
+    p_sim.add_argument('--no-sim-cache', dest='simcache',
+                       default=True, action='store_false',
+                       help='Do not use or save cached fight simulations')
+    p_sim.add_argument('-a', dest='use_async',
+                       default=False, action='store_true',
+                       help='Show simulations as they finish, using asyncio')
 
     p_quest = subparsers.add_parser('quests', help="Show questing info")
     p_quest.set_defaults(update=False)
@@ -1017,11 +1498,19 @@ def main():
     if 'mob' in args and 'all' in args.mob:
         args.mob = FightSimReport.mobs
 
+    sim_cache = None
+    if args.cmd in ('best', 'sim') and args.simcache:
+        cf.makedirs()
+        sim_cache = SimCache(cf.sim_cache_path)
+
     if args.cmd == 'gear':
         show_raider(db, rids[0])
     elif args.cmd == 'best':
         calc_best_gear(db, rids[0], args.count, args.url, args.mob,
-                       sort_total=args.totalsort)
+                       sort_total=args.totalsort, prune=args.prune,
+                       optimize=args.optimize,
+                       concurrency=args.concurrency, cache=sim_cache,
+                       tolerance=args.tolerance)
     elif args.cmd == 'quests':
         show_quest_info(db, rids, rewards=args.count,
                         showall=args.verbose, csvfile=args.csvfile)
@@ -1031,7 +1520,13 @@ def main():
             url += ':3000'
         if '://' not in url:
             url = 'http://' + url
-        call_fight_simulator(url, db, rids, args.mob, args.count)
+        call_fight_simulator(url, db, rids, args.mob, args.count,
+                             concurrency=args.concurrency, cache=sim_cache,
+                             use_async=args.use_async,
+                             tolerance=args.tolerance)
+
+    if args.cmd in ('gear', 'best') and args.memostats:
+        print_memo_stats()
 
 
 if __name__ == '__main__':
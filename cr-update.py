@@ -1,24 +1,39 @@
 #!./venv/bin/python
 import argparse
+import array
 import calendar
+import concurrent.futures
 import contextlib
 import datetime
+import gzip
+import hashlib
+import itertools
 import json
 import mmh3
 import os
 import requests
 import sqlite3
 import struct
-import subprocess
 import sys
 import tempfile
 import threading
+import time
+import zlib
 
 cr_conf = __import__('cr-conf')
 cf = cr_conf.conf
 cr_report = __import__('cr-report')
 
 schema_version = 3
+delta_version = 1
+# snapshot compression codecs and file suffixes, zstd is optional
+snapshot_codecs = {'gzip': '.gz', 'zstd': '.zst'}
+gzip_level = 6
+zstd_level = 9
+fetch_concurrency = 8
+multicall_chunk = 300
+# recruiting.cost above this is a placeholder and must be fetched again
+recruit_cost_sentinel = 1000000000
 
 
 class DBVersionError(Exception):
@@ -105,6 +120,8 @@ def setupdb(db):
         next INTEGER,
         cost INTEGER,
         FOREIGN KEY(raider) REFERENCES raiders(id))''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS recruiting__next
+        on recruiting(next)''')
 
     cur.execute('''CREATE TABLE IF NOT EXISTS quests(
         raider INTEGER PRIMARY KEY,
@@ -155,8 +172,9 @@ def schema_upgrade_v2(db):
     cur.execute('''SELECT l.local_id, l.raider_id, l.equipped, l.slot, u.name,
         u.strength, u.intelligence, u.agility, u.wisdom, u.charm, u.luck
         FROM gear_localid l, gear_uniq u WHERE l.dedup_id = u.dedup_id''')
-    for row in list(cur.fetchall()):
-        hash = hash_gear_uniq(*row[-7:])
+    rows = list(cur.fetchall())
+    hashes = hash_gear_uniq_many((row[-7], row[-6:]) for row in rows)
+    for row, hash in zip(rows, hashes):
         cur.execute('''INSERT INTO gear (local_id, raider_id, equipped, slot,
             name, strength, intelligence, agility, wisdom, charm, luck, hash)
             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', row + (hash,))
@@ -202,25 +220,114 @@ def checkdb(db):
 
 class GearDB():
     _dumpver = 1
+    _journal_magic = b'CRGJ\x01\x00\x00\x00'
+    _journal_count = struct.Struct('<I')
+    _journal_strlen = struct.Struct('<i')
+    _journal_gear = struct.Struct('<qiii6i')
+    _journal_extra = struct.Struct('<iiq')
+    _journal_commit = struct.Struct('<QI')
     _extra_keys = set(('endless',))
 
     def __init__(self):
-        self._rows = [None]
-        self._gearids = {}
         self._extra = {}
         self._lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        # gear rows are stored as typed columns indexed by local id, with
+        # slot and name as indexes into a table of interned strings. row 0
+        # is unused and a name index of -1 marks a gap in the local ids
+        self._hashes = array.array('q', (0,))
+        self._raiders = array.array('i', (0,))
+        self._slots = array.array('i', (-1,))
+        self._names = array.array('i', (-1,))
+        self._stats = array.array('i', (0,) * 6)
+        self._strings = []
+        self._string_ids = {}
+        # open addressing hash table of local ids keyed on (raider, hash).
+        # lookups without the lock go through _view, which is only ever
+        # replaced whole: rows are appended to the columns before their
+        # local id goes into the index, and a grown index is filled in
+        # before it is published
+        self._index = array.array('i', (0,)) * 1024
+        self._index_used = 0
+        self._view = (self._index, self._hashes, self._raiders)
+        # how much of the above has been written to the journal
+        self._journal = None
 
     @property
     def last_local_id(self):
-        nrows = len(self._rows)
+        nrows = len(self._hashes)
         return nrows - 1 if nrows > 1 else None
 
+    def _intern(self, string):
+        idx = self._string_ids.get(string)
+        if idx is None:
+            idx = self._string_ids[string] = len(self._strings)
+            self._strings.append(string)
+        return idx
+
+    @staticmethod
+    def _index_pos(view, raider_id, hash):
+        # linear probe for the key, or for the empty slot to insert it at
+        index, hashes, raiders = view
+        mask = len(index) - 1
+        pos = (hash ^ (raider_id * 0x9e3779b97f4a7c15)) & mask
+        while True:
+            local_id = index[pos]
+            if not local_id or (hashes[local_id] == hash and
+                                raiders[local_id] == raider_id):
+                return pos
+            pos = (pos + 1) & mask
+
+    def _index_add(self, raider_id, hash, local_id):
+        if (self._index_used + 1) * 2 > len(self._index):
+            old = self._index
+            view = (array.array('i', (0,)) * (len(old) * 2),
+                    self._hashes, self._raiders)
+            for i in old:
+                if i:
+                    view[0][self._index_pos(
+                        view, self._raiders[i], self._hashes[i])] = i
+            self._index = view[0]
+            self._view = view
+        pos = self._index_pos(self._view, raider_id, hash)
+        if not self._index[pos]:
+            self._index_used += 1
+        self._index[pos] = local_id
+
     def _add_gear(self, hash, raider_id, slot, name, stats):
-        self._rows.append((hash, raider_id, slot, name) + tuple(stats))
-        self._gearids.setdefault(raider_id, {})[hash] = self.last_local_id
+        self._add_interned(hash, raider_id, self._intern(slot),
+                           self._intern(name), stats)
+
+    def _add_interned(self, hash, raider_id, slot_idx, name_idx, stats):
+        self._hashes.append(hash)
+        self._raiders.append(raider_id)
+        self._slots.append(slot_idx)
+        self._names.append(name_idx)
+        self._stats.extend(stats)
+        self._index_add(raider_id, hash, self.last_local_id)
+
+    def _add_gaps(self, count):
+        self._hashes.extend((0,) * count)
+        self._raiders.extend((0,) * count)
+        self._slots.extend((-1,) * count)
+        self._names.extend((-1,) * count)
+        self._stats.extend((0,) * (6 * count))
 
     def _get_localid(self, raider_id, hash):
-        return self._gearids.get(raider_id, {}).get(hash)
+        # safe without the lock, a miss may just be a row being added
+        view = self._view
+        return view[0][self._index_pos(view, raider_id, hash)] or None
+
+    def _row(self, local_id):
+        if self._names[local_id] < 0:
+            return (None,)
+        return (self._hashes[local_id], self._raiders[local_id],
+                self._strings[self._slots[local_id]],
+                self._strings[self._names[local_id]]) + \
+            tuple(self._stats[local_id * 6:local_id * 6 + 6])
 
     def _set_extra(self, raider_id, key, val):
         assert key in self._extra_keys
@@ -234,11 +341,11 @@ class GearDB():
             sys.exit(1)
 
         with self._lock:
-            self._rows = [None]
-            self._gearids = {}
+            self._clear()
             self._extra = data['raiders']
-            for row in data['gear']:
-                hash = hash_gear_uniq(*row[-7:])
+            hashes = hash_gear_uniq_many(
+                (row[-7], row[-6:]) for row in data['gear'])
+            for row, hash in zip(data['gear'], hashes):
                 assert hash == row[0]
                 params = [hash] + list(row[1:-6]) + [row[-6:]]
                 self._add_gear(*params)
@@ -247,9 +354,188 @@ class GearDB():
         with self._lock:
             data = {'version': self._dumpver,
                     'raiders': self._extra,
-                    'gear': self._rows[1:]}
+                    'gear': [self._row(i)
+                             for i in range(1, len(self._hashes))]}
             json.dump(data, fh)
 
+    # the journal is a header followed by batches, each holding a block of
+    # new strings, a block of fixed width gear rows (slot and name are
+    # string indexes, -1 for a gap) and a block of extra values, and ended
+    # by a commit record with the total row count and a crc of the batch.
+    # a torn batch at the end is dropped on load, and extra values which
+    # were overwritten by later batches are dropped by compaction
+    def _journal_batch(self, strings, rows, extras):
+        buf = bytearray(b'S')
+        buf += self._journal_count.pack(len(strings))
+        for string in strings:
+            if string is None:
+                buf += self._journal_strlen.pack(-1)
+            else:
+                string = string.encode()
+                buf += self._journal_strlen.pack(len(string))
+                buf += string
+        buf += b'G'
+        buf += self._journal_count.pack(len(rows))
+        for row in rows:
+            buf += self._journal_gear.pack(*row)
+        buf += b'X'
+        buf += self._journal_count.pack(len(extras))
+        for extra in extras:
+            buf += self._journal_extra.pack(*extra)
+        crc = zlib.crc32(buf)
+        buf += b'C'
+        buf += self._journal_commit.pack(len(self._hashes) - 1, crc)
+        return buf
+
+    def _journal_rows(self, start):
+        stats = self._stats
+        return [(self._hashes[i], self._raiders[i],
+                 self._slots[i], self._names[i]) +
+                tuple(stats[i * 6:i * 6 + 6])
+                for i in range(start, len(self._hashes))]
+
+    def _journal_extras(self, journaled):
+        extras = []
+        for raider_id, vals in self._extra.items():
+            for key, val in vals.items():
+                if journaled.get((int(raider_id), key)) != val:
+                    extras.append((int(raider_id), self._intern(key), val))
+        return extras
+
+    def _journal_state(self, path, size, waste=0):
+        return {
+            'path': path, 'size': size, 'waste': waste,
+            'strings': len(self._strings), 'rows': len(self._hashes),
+            'extra': {(int(r), k): v
+                      for r, d in self._extra.items() for k, v in d.items()}}
+
+    def _journal_written(self, old, journal):
+        # a load may have replaced everything while the batch was written
+        with self._lock:
+            if self._journal is old:
+                self._journal = journal
+
+    def compact_journal(self, path):
+        with self._journal_lock:
+            self._compact_journal(path)
+
+    def _compact_journal(self, path):
+        with self._lock:
+            old = self._journal
+            batch = self._journal_batch(self._strings, self._journal_rows(1),
+                                        self._journal_extras({}))
+            journal = self._journal_state(
+                path, len(self._journal_magic) + len(batch))
+        with permatempfile(path, suffix='.journal') as fh:
+            fh.write(self._journal_magic)
+            fh.write(batch)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._journal_written(old, journal)
+
+    def save_journal(self, path):
+        # only the batch is built with the lock held, the write and fsync
+        # happen outside it so imports can carry on adding gear meanwhile
+        with self._journal_lock:
+            with self._lock:
+                old = self._journal
+                if (old is None or old['path'] != path or
+                        not os.path.exists(path)):
+                    nrows = len(self._hashes) - 1
+                    journal = None
+                else:
+                    extras = self._journal_extras(old['extra'])
+                    rows = self._journal_rows(old['rows'])
+                    nrows = len(rows)
+                    if not rows and not extras:
+                        return 0
+                    batch = self._journal_batch(
+                        self._strings[old['strings']:], rows, extras)
+                    waste = old['waste'] + self._journal_extra.size * sum(
+                        1 for r, k, v in extras
+                        if (r, self._strings[k]) in old['extra'])
+                    journal = self._journal_state(
+                        path, old['size'] + len(batch), waste)
+            if journal is not None:
+                with open(path, 'ab') as fh:
+                    fh.write(batch)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                self._journal_written(old, journal)
+            if journal is None or journal['waste'] * 2 > journal['size']:
+                self._compact_journal(path)
+        return nrows
+
+    def _parse_journal_batch(self, data, pos):
+        start = pos
+        blocks = []
+        for tag, fixed in ((b'S', None), (b'G', self._journal_gear),
+                           (b'X', self._journal_extra)):
+            if data[pos:pos + 1] != tag:
+                raise ValueError('bad gear journal record')
+            count, = self._journal_count.unpack_from(data, pos + 1)
+            pos += 1 + self._journal_count.size
+            if fixed is None:
+                strings = []
+                for _ in range(count):
+                    size, = self._journal_strlen.unpack_from(data, pos)
+                    pos += self._journal_strlen.size
+                    if size < 0:
+                        strings.append(None)
+                    else:
+                        strings.append(data[pos:pos + size].decode())
+                        pos += size
+                blocks.append(strings)
+            else:
+                end = pos + count * fixed.size
+                if end > len(data):
+                    raise ValueError('truncated gear journal')
+                blocks.append(list(fixed.iter_unpack(data[pos:end])))
+                pos = end
+        if data[pos:pos + 1] != b'C':
+            raise ValueError('bad gear journal record')
+        nrows, crc = self._journal_commit.unpack_from(data, pos + 1)
+        if crc != zlib.crc32(data[start:pos]):
+            raise ValueError('bad gear journal checksum')
+        return pos + 1 + self._journal_commit.size, nrows, blocks
+
+    def load_journal(self, path):
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        if not data.startswith(self._journal_magic):
+            raise ValueError('%s is not a gear journal' % (path,))
+
+        with self._lock:
+            self._clear()
+            self._extra = {}
+            pos = len(self._journal_magic)
+            while pos < len(data):
+                try:
+                    end, nrows, blocks = self._parse_journal_batch(data, pos)
+                except (ValueError, struct.error, UnicodeDecodeError):
+                    break
+                strings, rows, extras = blocks
+                if nrows != len(self._hashes) - 1 + len(rows):
+                    break
+                for string in strings:
+                    self._intern(string)
+                for row in rows:
+                    if row[3] < 0:
+                        self._add_gaps(1)
+                    else:
+                        self._add_interned(*row[:4], row[4:])
+                for raider_id, key, val in extras:
+                    self._extra.setdefault(raider_id, {})[
+                        self._strings[key]] = val
+                pos = end
+            if pos < len(data):
+                # drop the torn batch so later appends follow a good one
+                print('truncating gear journal %s at %d of %d bytes' % (
+                    path, pos, len(data)), file=sys.stderr)
+                with open(path, 'r+b') as fh:
+                    fh.truncate(pos)
+            self._journal = self._journal_state(path, pos)
+
     def load_from_sql(self, cur):
         cur.execute('''SELECT local_id, hash, raider_id, slot, name,
             strength, intelligence, agility, wisdom, charm, luck
@@ -260,15 +546,14 @@ class GearDB():
         extra = {r: {'endless': l} for r, l in cur.fetchall()}
 
         with self._lock:
-            self._rows = [None]
-            self._gearids = {}
+            self._clear()
             self._extra = extra
             next_id = 1
             for row in rows:
                 local_id, hash, raider_id, slot, name = row[:5]
                 stats = row[5:]
                 if local_id > next_id:
-                    self._rows.extend(((None,),) * (local_id - next_id))
+                    self._add_gaps(local_id - next_id)
                 self._add_gear(hash, raider_id, slot, name, stats)
                 assert local_id == self.last_local_id
                 next_id = local_id + 1
@@ -280,7 +565,8 @@ class GearDB():
         newrows = ()
         with self._lock:
             if next_local_id <= self.last_local_id:
-                newrows = self._rows[next_local_id:]
+                newrows = [self._row(i)
+                           for i in range(next_local_id, len(self._hashes))]
             endless = [{'r': r, 'e': d['endless']}
                        for r, d in self._extra.items() if 'endless' in d]
 
@@ -294,28 +580,51 @@ class GearDB():
         return len(newrows)
 
     def add_multi_inventory(self, multi):
+        # parse, hash and look up without the lock, then only take it to
+        # add whatever was missing. another thread may have added an item
+        # in the meantime, so look the misses up again first
+        parsed = []
+        endless = []
+        for raider in multi:
+            raider_id = raider['tokenId']
+            for inv in raider['inventory']:
+                parsed.append((raider_id, inv) + get_item_name_stats(inv))
+            if 'lastEndless' in raider:
+                endless.append(
+                    (raider_id, iso_datetime_to_secs(raider['lastEndless'])))
+        hashes = hash_gear_uniq_many(row[2:] for row in parsed)
+        items = [(raider_id, hash, name, stats, inv,
+                  self._get_localid(raider_id, hash))
+                 for (raider_id, inv, name, stats), hash
+                 in zip(parsed, hashes)]
+
         res = []
         with self._lock:
-            for raider in multi:
-                raider_id = raider['tokenId']
-                for inv in raider['inventory']:
-                    hash, name, stats = get_item_stats(inv)
+            for raider_id, hash, name, stats, inv, local_id in items:
+                wasnew = False
+                if local_id is None:
                     local_id = self._get_localid(raider_id, hash)
+                if local_id is None:
                     slot = inv['item']['slot']
-                    wasnew = local_id is None
-                    if local_id is None:
-                        self._add_gear(hash, raider_id, slot, name, stats)
-                        local_id = self.last_local_id
-                    res.append((local_id, wasnew, inv))
-                if 'lastEndless' in raider:
-                    secs = iso_datetime_to_secs(raider['lastEndless'])
-                    self._set_extra(raider_id, 'endless', secs)
+                    self._add_gear(hash, raider_id, slot, name, stats)
+                    local_id = self.last_local_id
+                    wasnew = True
+                res.append((local_id, wasnew, inv))
+            for raider_id, secs in endless:
+                self._set_extra(raider_id, 'endless', secs)
         return res
 
 
 geardb = GearDB()
 
 
+def convert_gear_json(jsonpath, journalpath, geardb=geardb):
+    with open(jsonpath) as fh:
+        geardb.load(fh)
+    geardb.compact_journal(journalpath)
+    return geardb
+
+
 class GoogAuth():
     def __init__(self):
         self._data = {}
@@ -409,30 +718,180 @@ def permatempfile(dest, suffix=None, mode=0o644, binary=True):
     os.rename(tmp.name, dest)
 
 
-def mv_to(srcpath, destpath):
-    subprocess.run(('mv', srcpath, destpath), check=True)
+def available_codecs():
+    codecs = ['gzip']
+    try:
+        import zstandard  # noqa: F401
+        codecs.append('zstd')
+    except ImportError:
+        pass
+    return codecs
 
 
-def gzip_to(srcpath, destdir, destname, periodic=noop):
-    with permatempfile(os.path.join(destdir, destname), mode=0o444) as tmp:
-        periodic(message='compressing %s to %s' % (
-            os.path.basename(srcpath), destname))
-        subprocess.run(('gzip', '-9cn', srcpath),
-                       stdin=subprocess.DEVNULL,
-                       stdout=tmp.fileno(),
-                       check=True)
-    periodic()
+def make_compressor(codec):
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=zstd_level).compressobj()
+    assert codec == 'gzip', codec
+    return zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
 
+def make_decompressor(codec):
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj()
+    assert codec == 'gzip', codec
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
 
-def gzip_from(srcpath, destdir, destname, periodic=noop):
+
+def compress_to(srcpath, destdir, destname, codec='gzip', periodic=noop):
+    comp = make_compressor(codec)
+    digest = hashlib.sha256()
     with permatempfile(os.path.join(destdir, destname), mode=0o444) as tmp:
-        periodic(message='decompressing %s to %s' % (
+        periodic(message='compressing %s to %s' % (
             os.path.basename(srcpath), destname))
-        subprocess.run(('gzip', '-cd', srcpath),
-                       stdin=subprocess.DEVNULL,
-                       stdout=tmp.fileno(),
-                       check=True)
+        with open(srcpath, 'rb') as fh:
+            for data in iter(lambda: fh.read(1 << 20), b''):
+                data = comp.compress(data)
+                digest.update(data)
+                tmp.write(data)
+                periodic()
+        data = comp.flush()
+        digest.update(data)
+        tmp.write(data)
     periodic()
+    return digest.hexdigest()
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for data in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+class SnapshotWriter():
+    # decompresses a snapshot download into fh while hashing it
+    def __init__(self, fh, codec):
+        self._fh = fh
+        self._codec = codec
+        self.reset()
+
+    def reset(self):
+        self._fh.seek(0)
+        self._fh.truncate()
+        self._decomp = make_decompressor(self._codec)
+        self._digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._digest.update(data)
+        self.size += len(data)
+        self._fh.write(self._decomp.decompress(data))
+
+    def write_file(self, path):
+        with open(path, 'rb') as fh:
+            for data in iter(lambda: fh.read(1 << 20), b''):
+                self.write(data)
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+    def finish(self, sha256=None):
+        self._fh.write(self._decomp.flush())
+        if sha256 is not None and self.hexdigest() != sha256:
+            raise ValueError('checksum mismatch, expected %s but got %s' % (
+                sha256, self.hexdigest()))
+        if not self._decomp.eof:
+            raise ValueError('truncated snapshot')
+
+
+def snapshot_version(cur, schema='main'):
+    cur.execute('SELECT name, value FROM %s.meta WHERE name IN (?, ?)' % (
+        schema,), ('snapshot-started', 'snapshot-updated'))
+    vals = dict(cur.fetchall())
+    return [vals.get('snapshot-started', 0), vals.get('snapshot-updated', 0)]
+
+
+def snapshot_tables(cur):
+    cur.execute('''SELECT name FROM main.sqlite_master
+        WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name''')
+    tables = {}
+    for table in [r[0] for r in cur.fetchall()]:
+        cur.execute('SELECT name, pk FROM PRAGMA_TABLE_INFO(?) ORDER BY cid',
+                    (table,))
+        info = cur.fetchall()
+        tables[table] = ([i[0] for i in info],
+                         [i[0] for i in sorted(info, key=lambda i: i[1])
+                          if i[1]])
+    return tables
+
+
+def write_snapshot_delta(db, prev_path, dest):
+    # diff the committed database against an older copy of it, by primary key
+    cur = db.cursor()
+    cur.execute('ATTACH DATABASE ? AS prev', (prev_path,))
+    try:
+        delta = {'version': delta_version,
+                 'from': snapshot_version(cur, 'prev'),
+                 'to': snapshot_version(cur),
+                 'tables': {}}
+        for table, (columns, key) in snapshot_tables(cur).items():
+            assert key, table
+            cols = ', '.join(columns)
+            cur.execute('SELECT %s FROM main.%s EXCEPT SELECT %s FROM prev.%s'
+                        % (cols, table, cols, table))
+            upsert = cur.fetchall()
+            cols = ', '.join(key)
+            cur.execute('SELECT %s FROM prev.%s EXCEPT SELECT %s FROM main.%s'
+                        % (cols, table, cols, table))
+            delete = cur.fetchall()
+            if upsert or delete:
+                delta['tables'][table] = {'columns': columns, 'key': key,
+                                          'upsert': upsert, 'delete': delete}
+    finally:
+        cur.execute('DETACH DATABASE prev')
+    with permatempfile(dest, mode=0o444) as tmp:
+        tmp.write(gzip.compress(json.dumps(delta).encode(), mtime=0))
+    return delta
+
+
+def apply_snapshot_deltas(db, deltas):
+    cur = db.cursor()
+    tables = snapshot_tables(cur)
+    db.commit()
+    cur.execute('BEGIN TRANSACTION')
+    try:
+        for delta in deltas:
+            if delta.get('version') != delta_version:
+                raise ValueError('unknown snapshot delta version %s' % (
+                    delta.get('version'),))
+            current = snapshot_version(cur)
+            if current != delta['from']:
+                raise ValueError(
+                    'snapshot delta from %d/%d does not apply to %d/%d' % (
+                        tuple(delta['from']) + tuple(current)))
+            for table, d in sorted(delta['tables'].items()):
+                if table not in tables or \
+                   set(d['columns']).difference(tables[table][0]) or \
+                   d['key'] != tables[table][1]:
+                    raise ValueError('snapshot delta table %s does not match'
+                                     ' local schema' % (table,))
+                cur.executemany('DELETE FROM %s WHERE %s' % (
+                    table, ' AND '.join('%s = ?' % i for i in d['key'])),
+                                d['delete'])
+                cur.executemany(
+                    'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (
+                        table, ', '.join(d['columns']),
+                        ', '.join('?' * len(d['columns']))), d['upsert'])
+            if snapshot_version(cur) != delta['to']:
+                raise ValueError('snapshot delta did not reach %d/%d' % (
+                    tuple(delta['to'])))
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
 
 
 def hash_gear_uniq(name, *stats):
@@ -445,13 +904,43 @@ def hash_gear_uniq(name, *stats):
     return pair[0] ^ pair[1]
 
 
-def get_item_stats(item):
+_gear_stats_struct = struct.Struct('!6q')
+
+
+def hash_gear_uniq_many(rows):
+    # same hashes as hash_gear_uniq for a batch of (name, stats) rows. the
+    # stats are all packed into one buffer up front and each name is only
+    # encoded once, leaving just the concatenation and mmh3 per row
+    rows = list(rows)
+    if not rows:
+        return []
+    names, stats = zip(*rows)
+    flat = list(itertools.chain.from_iterable(stats))
+    if not (set(map(type, names)) <= {str} and
+            set(map(len, stats)) == {6} and
+            set(map(type, flat)) <= {int, bool}):
+        bad = next((name, stats) for name, stats in rows
+                   if not isinstance(name, str) or len(stats) != 6 or
+                   not all(isinstance(i, int) for i in stats))
+        raise AssertionError(bad)
+
+    encoded = {name: name.encode('utf-8') for name in set(names)}
+    size = _gear_stats_struct.size
+    statbuf = struct.pack('!%dq' % (len(flat),), *flat)
+    hash64 = mmh3.hash64
+    res = []
+    for i, name in enumerate(names):
+        pair = hash64(encoded[name] + statbuf[i * size:(i + 1) * size])
+        res.append(pair[0] ^ pair[1])
+    return res
+
+
+def get_item_name_stats(item):
     # XXX should switch hash to item['item']['internalName'] instead
     name = item['item']['name']
     stats_dict = item['item'].get('stats') or {}
     stats = tuple(stats_dict.get(i, 0) for i in cf.stat_names)
-    hash = hash_gear_uniq(name, *stats)
-    return hash, name, stats
+    return name, stats
 
 
 def get_owned_raider_nfts(periodic=noop, session=None):
@@ -507,7 +996,7 @@ def get_raider_ids(periodic=noop, session=None):
     return owned, questing
 
 
-def import_all_raiders(db, periodic=noop, session=None):
+def find_all_raiders(db, periodic=noop, session=None):
     owned, questing = get_raider_ids(periodic=periodic, session=session)
     raiders = set(owned)
     raiders.update(questing)
@@ -521,15 +1010,7 @@ def import_all_raiders(db, periodic=noop, session=None):
         print('Warning: skipping %d unknown raiders: %s' % (
             len(skipped), ' '.join(sorted(map(str, skipped)))),
               file=sys.stderr)
-
-    periodic()
-
-    cur.execute('BEGIN TRANSACTION')
-    ids = tuple(sorted(raiders))
-    import_raiders(cur, ids, periodic=periodic, session=session)
-    db.commit()
-    periodic()
-    return ids, questing
+    return tuple(sorted(raiders)), questing
 
 
 def import_some_raiders(db, rids, periodic=noop, session=None):
@@ -541,40 +1022,79 @@ def import_some_raiders(db, rids, periodic=noop, session=None):
     periodic()
 
 
-def import_raiders(cur, all_ids, periodic=noop, session=None):
+def import_raiders(cur, all_ids, periodic=noop, session=None,
+                   concurrency=None):
     periodic('Importing raider data from CR API')
+    if concurrency is None:
+        concurrency = fetch_concurrency
+    times = {'list': 0, 'insert': 0, 'fetch': 0, 'wait': 0, 'extended': 0}
+
+    def fetch_meta(rid):
+        start = time.monotonic()
+        r = req_get(session, '%s/game/raider/%s' % (cf.cr_api_url, rid),
+                    params={'key': cf.cr_api_key})
+        data = r.json()
+        return data, time.monotonic() - start
 
-    all_raider_meta = []
-    for first in range(0, len(all_ids), 50):
-        chunk_ids = all_ids[first:first+50]
-        periodic(message='fetching %d raiders' % (len(chunk_ids),))
-        r = req_get(session, '%s/raiders/' % (cf.cr_api_url,),
-                    params={'ids[]': chunk_ids})
-        periodic()
-        data_rows = r.json()
-
-        for idx, data in enumerate(data_rows, first):
-            periodic(message='importing raider %d/%d - %d %s' % (
-                idx + 1, len(all_ids), data['id'], data['name']))
-            params = {i['trait_type']: i['value']
-                      for i in data['attributes'] if 'value' in i}
-            params['id'] = data['id']
-            params['image'] = data['image']
-            params['name'] = data['name'].split('] ', 1)[1]
-            cur.execute('''INSERT OR REPLACE INTO raiders (
-                id, name, image,
-                race, generation, birthday, experience, level,
-                strength, intelligence, agility, wisdom, charm, luck) VALUES (
-                :id, :name, :image,
-                :Race, :Generation, :Birthday, :Experience, :Level,
-                :Strength, :Intelligence, :Agility, :Wisdom, :Charm, :Luck)''',
-                        params)
-
+    # only the /game/raider fetches run on the pool, periodic and all
+    # database writes stay on this thread
+    pending = []
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        for first in range(0, len(all_ids), 50):
+            chunk_ids = all_ids[first:first+50]
+            periodic(message='fetching %d raiders' % (len(chunk_ids),))
+            start = time.monotonic()
+            r = req_get(session, '%s/raiders/' % (cf.cr_api_url,),
+                        params={'ids[]': chunk_ids})
+            data_rows = r.json()
+            times['list'] += time.monotonic() - start
             periodic()
-            r = req_get(session, '%s/game/raider/%s' % (
-                cf.cr_api_url, data['id']), params={'key': cf.cr_api_key})
-            all_raider_meta.append(r.json())
+
+            start = time.monotonic()
+            for idx, data in enumerate(data_rows, first):
+                pending.append(executor.submit(fetch_meta, data['id']))
+                periodic(message='importing raider %d/%d - %d %s' % (
+                    idx + 1, len(all_ids), data['id'], data['name']))
+                params = {i['trait_type']: i['value']
+                          for i in data['attributes'] if 'value' in i}
+                params['id'] = data['id']
+                params['image'] = data['image']
+                params['name'] = data['name'].split('] ', 1)[1]
+                cur.execute('''INSERT OR REPLACE INTO raiders (
+                    id, name, image,
+                    race, generation, birthday, experience, level,
+                    strength, intelligence, agility, wisdom, charm, luck)
+                    VALUES (
+                    :id, :name, :image,
+                    :Race, :Generation, :Birthday, :Experience, :Level,
+                    :Strength, :Intelligence, :Agility, :Wisdom, :Charm,
+                    :Luck)''', params)
+            times['insert'] += time.monotonic() - start
+
+        all_raider_meta = []
+        start = time.monotonic()
+        for idx, future in enumerate(pending):
+            if idx % 50 == 0:
+                periodic(message='fetched extended data for %d/%d raiders' % (
+                    idx, len(pending)))
+            data, elapsed = future.result()
+            times['fetch'] += elapsed
+            all_raider_meta.append(data)
+        times['wait'] += time.monotonic() - start
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+    start = time.monotonic()
     import_raider_extended(cur, all_raider_meta, periodic=periodic)
+    times['extended'] += time.monotonic() - start
+    periodic(message=(
+        '%d raiders with %d workers: list %.2fs, insert %.2fs,'
+        ' fetch latency %.2fs (%.2fs waiting), extended %.2fs') % (
+            len(all_raider_meta), concurrency, times['list'], times['insert'],
+            times['fetch'], times['wait'], times['extended']))
 
 
 def import_raider_extended(cur, raiders, periodic=noop):
@@ -620,125 +1140,245 @@ def timestamp_utc(when=None):
     return int(calendar.timegm(when.utctimetuple()))
 
 
+def fill_update_ids(cur, ids):
+    cur.execute('''CREATE TEMP TABLE IF NOT EXISTS update_ids(
+        id INTEGER PRIMARY KEY)''')
+    cur.execute('DELETE FROM update_ids')
+    cur.executemany('INSERT OR IGNORE INTO update_ids (id) VALUES (?)',
+                    ((i,) for i in ids))
+
+
 def import_raider_gear(db, periodic=noop, session=None):
+    raiders = fetch_raider_gear(periodic=periodic, session=session)
+    if raiders is not None:
+        store_raider_gear(db, raiders, periodic=periodic)
+
+
+def fetch_raider_gear(periodic=noop, session=None):
     periodic('Importing raider data from private CR API')
     r = req_get(session, cf.cr_intapi_url + '/raiders')
     if not r.ok:
         periodic(message='error: server responses %d %s' % (
             r.status_code, r.reason))
-        return
+        return None
     data = r.json()
     periodic(message='found %d non-questing raiders' % (
         len(data['raiders']),))
+    return data['raiders']
+
+
+def store_raider_gear(db, raiders, periodic=noop):
     cur = db.cursor()
     cur.execute('BEGIN TRANSACTION')
-    import_raider_extended(cur, data['raiders'], periodic=periodic)
+    import_raider_extended(cur, raiders, periodic=periodic)
     db.commit()
 
 
+def multicall(calls, periodic=noop, session=None):
+    res = []
+    for first in range(0, len(calls), multicall_chunk):
+        periodic()
+        res.extend(cf.eth_multicall(calls[first:first+multicall_chunk],
+                                    session=session))
+    periodic()
+    return res
+
+
+def multicall_value(result, what):
+    ok, val = result
+    if not ok:
+        raise ValueError('contract call failed: %s' % (what,))
+    return val
+
+
 def import_raider_recruitment(db, idlist, full=False,
                               periodic=noop, session=None):
+    utcnow_secs, due = plan_raider_recruitment(db, idlist, full=full,
+                                               periodic=periodic)
+    rows = []
+    if due:
+        rows = fetch_raider_recruitment(due, utcnow_secs,
+                                        periodic=periodic, session=session)
+    store_raider_recruitment(db, rows, periodic=periodic)
+
+
+def plan_raider_recruitment(db, idlist, full=False, periodic=noop):
     periodic('Importing recruitment data from chain',
-             message='fetching contract ABI')
+             message='finding raiders to update')
     cur = db.cursor()
+    utcnow_secs = timestamp_utc()
+    if full:
+        due = [(rid, None, None) for rid in sorted(idlist)]
+    else:
+        # only raiders with no row, a placeholder cost or a past recruit
+        # time are looked at, everyone else is left alone. the past recruit
+        # times come from the index on next, the rest need every id looked
+        # up since they include raiders without a row at all
+        fill_update_ids(cur, idlist)
+        cur.execute('''SELECT c.raider, c.next, c.cost
+            FROM recruiting c INDEXED BY recruiting__next
+            JOIN update_ids i ON i.id = c.raider
+            WHERE c.next < ?
+            UNION
+            SELECT i.id, c.next, c.cost FROM update_ids i
+            LEFT JOIN recruiting c ON c.raider = i.id
+            WHERE c.raider IS NULL OR c.next IS NULL
+                OR c.cost IS NULL OR c.cost > ?
+            ORDER BY 1''', (utcnow_secs, recruit_cost_sentinel))
+        due = cur.fetchall()
+    periodic(message='%d of %d raider(s) due for update' % (
+        len(due), len(idlist)))
+    return utcnow_secs, due
+
+
+def fetch_raider_recruitment(due, utcnow_secs, periodic=noop, session=None):
+    periodic('Importing recruitment data from chain',
+             message='fetching contract ABI')
     recruiting = cf.get_eth_contract('recruiting', session=session).functions
-    for idx, rid in enumerate(sorted(idlist)):
-        periodic(message='%d/%d - raider %d' % (idx + 1, len(idlist), rid))
-        cost, next_time = None, None
-        if not full:
-            cur.execute('SELECT next, cost FROM recruiting WHERE raider = ?',
-                        (rid,))
-            rows = cur.fetchall()
-            if len(rows):
-                next_time, cost = rows[0]
-        changed = False
-
-        if cost is None or cost > 1000000000:
-            cost = recruiting.getRaiderRecruitCost(rid).call()
-            periodic()
-            changed = True
-
-        utcnow_secs = timestamp_utc()
-        if next_time is None or next_time < utcnow_secs:
-            if recruiting.canRaiderRecruit(rid).call():
+    cf.get_eth_contract('multicall3', session=session)
+    wanted = []
+    calls = []
+    for rid, next_time, cost in due:
+        need_cost = cost is None or cost > recruit_cost_sentinel
+        need_next = next_time is None or next_time < utcnow_secs
+        if need_cost:
+            calls.append(recruiting.getRaiderRecruitCost(rid))
+        if need_next:
+            # nextRecruitTime is only used if canRaiderRecruit is false
+            calls.append(recruiting.canRaiderRecruit(rid))
+            calls.append(recruiting.nextRecruitTime(rid))
+        if need_cost or need_next:
+            wanted.append((rid, cost, next_time, need_cost, need_next))
+
+    periodic(message='fetching %d value(s) for %d raider(s)' % (
+        len(calls), len(wanted)))
+    results = iter(multicall(calls, periodic=periodic, session=session))
+    rows = []
+    for rid, cost, next_time, need_cost, need_next in wanted:
+        if need_cost:
+            cost = multicall_value(next(results),
+                                   'getRaiderRecruitCost(%d)' % (rid,))
+        if need_next:
+            can_recruit = multicall_value(next(results),
+                                          'canRaiderRecruit(%d)' % (rid,))
+            delta = next(results)
+            if can_recruit:
                 next_time = 0
             else:
-                delta = recruiting.nextRecruitTime(rid).call()
-                next_time = utcnow_secs + delta
-            periodic()
-            changed = True
+                next_time = utcnow_secs + multicall_value(
+                    delta, 'nextRecruitTime(%d)' % (rid,))
+        rows.append((rid, next_time, cost))
+    return rows
 
-        if changed:
-            cur.execute('''INSERT OR REPLACE INTO recruiting (
-                raider, next, cost) VALUES (?, ?, ?)''',
-                        (rid, next_time, cost))
+
+def store_raider_recruitment(db, rows, periodic=noop):
+    cur = db.cursor()
+    cur.executemany('''INSERT OR REPLACE INTO recruiting (
+        raider, next, cost) VALUES (?, ?, ?)''', rows)
     periodic()
     db.commit()
 
 
 def import_raider_quests(db, idlist, questing_ids=None,
                          periodic=noop, session=None):
-    import web3
+    rows = fetch_raider_quests(idlist, questing_ids=questing_ids,
+                               periodic=periodic, session=session)
+    store_raider_quests(db, rows, periodic=periodic)
 
-    def sql_insert(p):
-        cur.execute(
-            'INSERT OR REPLACE INTO quests (%s) VALUES (%s)' % (
-                ', '.join(sorted(p.keys())), ', '.join('?' * len(p))),
-            tuple(p[i] for i in sorted(p.keys())))
-        periodic()
 
-    cur = db.cursor()
+def fetch_raider_quests(idlist, questing_ids=None,
+                        periodic=noop, session=None):
     periodic('Importing quest data from chain',
              message='fetching contract ABI')
     questing = cf.get_eth_contract('questing-raiders',
                                    session=session).functions
+    cf.get_eth_contract('multicall3', session=session)
+    p = {'periodic': periodic, 'session': session}
+    idlist = sorted(idlist)
 
-    for idx, rid in enumerate(sorted(idlist)):
-        periodic(message='%d/%d - raider %d' % (idx + 1, len(idlist), rid))
-        onquest = (rid in questing_ids) if questing_ids else \
-            questing.onQuest(rid).call()
-        periodic()
-        params = {'raider': rid}
-        if not onquest:
-            params['status'] = 0
-            sql_insert(params)
-            continue
-        periodic()
-        params['contract'] = questing.raiderQuest(rid).call()
-        periodic()
-
-        try:
-            myquest = cf.get_eth_contract(address=params['contract'],
-                                          session=session).functions
-            periodic()
-        except ValueError:
-            print('unknown quest contract for raider %d: %s' % (
-                rid, params['contract']), file=sys.stderr)
-            continue
-
-        params['status'] = myquest.raiderStatus(rid).call()
-        periodic()
-        returning = cf.quest_returning[params['status']]
-        if returning is None:
-            sql_insert(params)
-            continue
-        utcnow_secs = timestamp_utc()
-        if returning:
+    # each stage below is one batch of calls for all raiders
+    if questing_ids:
+        onquest = [rid for rid in idlist if rid in questing_ids]
+    else:
+        periodic(message='checking %d raider(s) for quests' % (len(idlist),))
+        res = multicall([questing.onQuest(rid) for rid in idlist], **p)
+        onquest = [rid for rid, r in zip(idlist, res)
+                   if multicall_value(r, 'onQuest(%d)' % (rid,))]
+    rows = {rid: {'raider': rid, 'status': 0}
+            for rid in set(idlist).difference(onquest)}
+
+    periodic(message='finding quests for %d raider(s)' % (len(onquest),))
+    res = multicall([questing.raiderQuest(rid) for rid in onquest], **p)
+    contracts = {}
+    quests = []
+    for rid, r in zip(onquest, res):
+        addr = multicall_value(r, 'raiderQuest(%d)' % (rid,))
+        if addr not in contracts:
             try:
-                delta = myquest.timeTillHome(rid).call()
-            except web3.exceptions.ContractLogicError:
-                delta = -1
-            params['returns_on'] = 0 if delta <= 0 else utcnow_secs + delta
-            periodic()
-        else:
-            questing_secs = myquest.timeQuesting(rid).call()
-            params['started_on'] = int(utcnow_secs - questing_secs)
-            periodic()
-            params['return_divisor'] = myquest.returnHomeTimeDivisor().call()
+                contracts[addr] = cf.get_eth_contract(
+                    address=addr, session=session).functions
+            except ValueError:
+                contracts[addr] = None
             periodic()
-            params['reward_time'] = myquest.calcRaiderRewardTime(rid).call()
-            periodic()
-        sql_insert(params)
+        if contracts[addr] is None:
+            print('unknown quest contract for raider %d: %s' % (rid, addr),
+                  file=sys.stderr)
+            continue
+        quests.append((rid, addr))
+
+    periodic(message='fetching quest status for %d raider(s)' % (
+        len(quests),))
+    res = multicall([contracts[addr].raiderStatus(rid)
+                     for rid, addr in quests], **p)
+    returning = []
+    active = []
+    for (rid, addr), r in zip(quests, res):
+        status = multicall_value(r, 'raiderStatus(%d)' % (rid,))
+        rows[rid] = {'raider': rid, 'contract': addr, 'status': status}
+        if cf.quest_returning[status]:
+            returning.append((rid, addr))
+        elif cf.quest_returning[status] is not None:
+            active.append((rid, addr))
+
+    # the return divisor is per quest, not per raider
+    divisor_addrs = sorted(set(addr for rid, addr in active))
+    calls = [contracts[addr].returnHomeTimeDivisor()
+             for addr in divisor_addrs]
+    for rid, addr in returning:
+        calls.append(contracts[addr].timeTillHome(rid))
+    for rid, addr in active:
+        calls.append(contracts[addr].timeQuesting(rid))
+        calls.append(contracts[addr].calcRaiderRewardTime(rid))
+    periodic(message='fetching quest times for %d raider(s)' % (
+        len(returning) + len(active),))
+    utcnow_secs = timestamp_utc()
+    res = iter(multicall(calls, **p))
+    divisors = {addr: multicall_value(next(res),
+                                      'returnHomeTimeDivisor(%s)' % (addr,))
+                for addr in divisor_addrs}
+    for rid, addr in returning:
+        ok, delta = next(res)
+        if not ok:
+            delta = -1
+        rows[rid]['returns_on'] = 0 if delta <= 0 else utcnow_secs + delta
+    for rid, addr in active:
+        questing_secs = multicall_value(next(res),
+                                        'timeQuesting(%d)' % (rid,))
+        rows[rid]['started_on'] = int(utcnow_secs - questing_secs)
+        rows[rid]['return_divisor'] = divisors[addr]
+        rows[rid]['reward_time'] = multicall_value(
+            next(res), 'calcRaiderRewardTime(%d)' % (rid,))
+    return rows
+
+
+def store_raider_quests(db, rows, periodic=noop):
+    cur = db.cursor()
+    for rid in sorted(rows.keys()):
+        p = rows[rid]
+        cur.execute(
+            'INSERT OR REPLACE INTO quests (%s) VALUES (%s)' % (
+                ', '.join(sorted(p.keys())), ', '.join('?' * len(p))),
+            tuple(p[i] for i in sorted(p.keys())))
     periodic()
     db.commit()
 
@@ -759,9 +1399,103 @@ def findraider(db, ident):
     return rid, (cur.fetchone()[0] > 0)
 
 
-def import_or_update(db, started_at=None, raiders=None, basic=True, gear=True,
+class StageAborted(Exception):
+    pass
+
+
+def stage_periodic(periodic, lock, abort):
+    # for import stages running side by side: each keeps its own section
+    # and hands it over with every message, so they don't mix up each
+    # other's status. abort stops a stage when another one has failed
+    last = [None]
+
+    def stage(section=None, message=None):
+        if abort.is_set():
+            raise StageAborted()
+        if section:
+            last[0] = section
+        if message:
+            with lock:
+                periodic(last[0], message)
+        else:
+            periodic()
+    return stage
+
+
+def import_pipelined(db, raiders, questers=None, basic=True, gear=True,
                      recruiting=True, questing=True,
                      periodic=noop, session=None):
+    # the private API and chain reads for the gear, recruitment and quest
+    # stages run on their own worker threads while the basic import from
+    # the CR API runs here. all database access stays on this thread, which
+    # stores the stages in the same order as the sequential import
+    lock = threading.Lock()
+    abort = threading.Event()
+    here = stage_periodic(periodic, lock, abort)
+    wall = time.monotonic()
+
+    due = None
+    if recruiting:
+        utcnow_secs, due = plan_raider_recruitment(db, raiders, periodic=here)
+        db.commit()
+    if due or questing:
+        # load the contracts once up front instead of racing for them
+        here('Importing data from chain', message='fetching contract ABIs')
+        for name in ('multicall3', 'recruiting', 'questing-raiders'):
+            cf.get_eth_contract(name, session=session)
+
+    def timed(func, *args, **kw):
+        start = time.monotonic()
+        res = func(*args, periodic=stage_periodic(periodic, lock, abort),
+                   session=session, **kw)
+        return res, time.monotonic() - start
+
+    jobs = {}
+    times = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+    try:
+        if gear:
+            jobs['gear'] = executor.submit(timed, fetch_raider_gear)
+        if due:
+            jobs['recruiting'] = executor.submit(
+                timed, fetch_raider_recruitment, due, utcnow_secs)
+        if questing:
+            jobs['questing'] = executor.submit(
+                timed, fetch_raider_quests, raiders, questing_ids=questers)
+
+        if basic:
+            start = time.monotonic()
+            import_some_raiders(db, raiders, periodic=here, session=session)
+            times['basic'] = time.monotonic() - start
+
+        results = {}
+        for name, job in jobs.items():
+            results[name], times[name] = job.result()
+            here()
+    except BaseException:
+        abort.set()
+        for job in jobs.values():
+            job.cancel()
+        raise
+    finally:
+        executor.shutdown()
+
+    here('Storing imported data')
+    if results.get('gear') is not None:
+        store_raider_gear(db, results['gear'], periodic=here)
+    if recruiting:
+        store_raider_recruitment(db, results.get('recruiting', []),
+                                 periodic=here)
+    if questing:
+        store_raider_quests(db, results['questing'], periodic=here)
+    here(message='%s, total %.2fs' % (
+        ', '.join('%s %.2fs' % i for i in sorted(times.items())),
+        time.monotonic() - wall))
+
+
+def import_or_update(db, started_at=None, raiders=None, basic=True, gear=True,
+                     recruiting=True, questing=True, pipelined=False,
+                     periodic=noop, session=None):
     p = {'periodic': periodic, 'session': session}
     info = {'schema-version': schema_version}
     cur = db.cursor()
@@ -777,19 +1511,25 @@ def import_or_update(db, started_at=None, raiders=None, basic=True, gear=True,
         db.commit()
         info['snapshot-started'] = timestamp_utc(started_at)
         need_finish = True
-        raiders, questers = import_all_raiders(db, **p)
+        basic = True
+        raiders, questers = find_all_raiders(db, **p)
     else:
         periodic('Updating raider(s) %s' % (raiders,))
         cur.execute("SELECT value FROM meta WHERE name = 'snapshot-started'")
         info['snapshot-started'] = cur.fetchone()[0]
+    if pipelined:
+        import_pipelined(db, raiders, questers=questers, basic=basic,
+                         gear=gear, recruiting=recruiting, questing=questing,
+                         **p)
+    else:
         if basic:
             import_some_raiders(db, raiders, **p)
-    if gear:
-        import_raider_gear(db, **p)
-    if recruiting:
-        import_raider_recruitment(db, raiders, **p)
-    if questing:
-        import_raider_quests(db, raiders, questing_ids=questers, **p)
+        if gear:
+            import_raider_gear(db, **p)
+        if recruiting:
+            import_raider_recruitment(db, raiders, **p)
+        if questing:
+            import_raider_quests(db, raiders, questing_ids=questers, **p)
 
     finished_at = datetime.datetime.utcnow()
     cur.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)',
@@ -802,6 +1542,70 @@ def import_or_update(db, started_at=None, raiders=None, basic=True, gear=True,
     return info, raiders
 
 
+def plan_update(db, raiders=None, now_secs=None):
+    # work out when the stored quest and recruiting state of each raider can
+    # next change on its own. returns (due, raider id, name, reason) tuples
+    # sorted by due time, due is None when only the owner can change things
+    if now_secs is None:
+        now_secs = timestamp_utc()
+    cur = db.cursor()
+    sql = '''SELECT r.id, r.level, r.name, c.raider, c.next, c.cost,
+        q.raider, q.status, q.returns_on
+        FROM raiders r
+        LEFT JOIN recruiting c ON c.raider = r.id
+        LEFT JOIN quests q ON q.raider = r.id'''
+    if raiders is not None:
+        fill_update_ids(cur, raiders)
+        sql += ' WHERE r.id IN (SELECT id FROM update_ids)'
+    cur.execute(sql)
+
+    plan = []
+    for row in cur.fetchall():
+        rid, level, name = row[:3]
+        c_raider, next_time, cost = row[3:6]
+        q_raider, status, returns_on = row[6:9]
+        due = []
+        if c_raider is None or next_time is None:
+            due.append((now_secs, 'no recruiting data'))
+        elif cost is None or cost > recruit_cost_sentinel:
+            due.append((now_secs, 'recruiting cost unknown'))
+        elif next_time > 0:
+            due.append((next_time, 'can recruit'))
+        if q_raider is None or status is None:
+            due.append((now_secs, 'no quest data'))
+        elif cf.quest_returning[status]:
+            if returns_on > 0:
+                due.append((returns_on, 'returns home'))
+        # rewards on an active quest don't change anything stored, the
+        # reports work them out from started_on and reward_time
+        when, reason = min(due) if due else (None, 'idle')
+        plan.append((when, rid, '[%d] %s' % (level, name), reason))
+    plan.sort(key=lambda p: (p[0] is None, p[0] or 0, p[1]))
+    return plan
+
+
+def print_update_plan(plan, now_secs):
+    report = cr_report.TabularReport((
+        ('id', 'ID', 'int', True),
+        ('name', 'Name', 'str', False),
+        ('due', 'Due', 'epoch_seconds', True),
+        ('in', 'In', 'interval_seconds', True),
+        ('reason', 'Reason', 'str', False)), sepwidth=2)
+    fmt = {
+        'str': str,
+        'int': str,
+        'interval_seconds': lambda v: (
+            '-' if v is None else cr_report.fmt_raider_timedelta(v)),
+        'epoch_seconds': lambda v: (
+            '-' if v is None else cr_report.fmt_timesecs_nicely(v)),
+    }
+    report.print([(rid, name, when,
+                   None if when is None else max(0, when - now_secs), reason)
+                  for when, rid, name, reason in plan], fmt)
+    due = sum(1 for p in plan if p[0] is not None and p[0] <= now_secs)
+    print('%d of %d raider(s) due for update' % (due, len(plan)))
+
+
 def ensure_raider_ids(db, vals, usage, session=None):
     raiders = []
     all_trusted = True
@@ -859,20 +1663,126 @@ def request_update(raiders, basic=True, gear=True, recruiting=True,
     return cf.opendb()
 
 
-def download_and_install_snapshot(url, periodic=noop, session=None):
-    with tempfile.TemporaryDirectory(prefix='crutil') as tmp:
-        gzpath = os.path.join(tmp, 'raiders.sqlite.gz')
-        dbfile = 'raiders.sqlite'
-        dbpath = os.path.join(tmp, dbfile)
+def fetch_resumable(url, partpath, out, periodic=noop, session=None):
+    # append to partpath, resuming it with a Range request if the ETag or
+    # Last-Modified saved with it still matches
+    tagpath = partpath + '.tag'
+    headers = {}
+    if os.path.exists(partpath) and os.path.exists(tagpath):
+        out.write_file(partpath)
+        with open(tagpath) as fh:
+            headers['If-Range'] = fh.read()
+        headers['Range'] = 'bytes=%d-' % (out.size,)
+    r = req_get(session, url, stream=True, headers=headers)
+    if r.status_code == 416:
+        # the partial file is already complete
+        return
+    if r.status_code == 206 and headers and \
+       r.headers.get('Content-Range', '').startswith('bytes %d-' % (
+           out.size,)):
+        periodic(message='resuming %s at %d bytes' % (url, out.size))
+        mode = 'ab'
+    elif r.status_code == 200:
         periodic(message='downloading %s' % (url,))
-        with open(gzpath, 'wb') as gzfh:
-            r = req_get(session, url)
-            for data in r.iter_content(chunk_size=16384):
-                gzfh.write(data)
-        gzip_from(gzpath, tmp, dbfile, periodic=periodic)
-        cf.opendb(dbpath)
-        os.chmod(dbpath, 0o644)
-        mv_to(dbpath, cf.db_path)
+        out.reset()
+        mode = 'wb'
+    else:
+        raise ValueError('failed to download %s: %d %s' % (
+            url, r.status_code, r.reason))
+
+    tag = r.headers.get('ETag')
+    if not tag or tag.startswith('W/'):
+        tag = r.headers.get('Last-Modified')
+    if tag:
+        with open(tagpath, 'w') as fh:
+            fh.write(tag)
+    elif os.path.exists(tagpath):
+        os.unlink(tagpath)
+    with open(partpath, mode) as fh:
+        for data in r.iter_content(chunk_size=65536):
+            fh.write(data)
+            out.write(data)
+            periodic()
+    if os.path.exists(tagpath):
+        os.unlink(tagpath)
+
+
+def download_and_install_snapshot(url, codec='gzip', sha256=None,
+                                  periodic=noop, session=None):
+    # decompress while downloading, straight into a file next to the db.
+    # the compressed file is kept so an interrupted download can resume and
+    # a complete one with the right checksum is not downloaded again
+    dlname = url.rsplit('/', 1)[-1]
+    dlpath = os.path.join(cf.download_dir, dlname)
+    partpath = dlpath + '.part'
+    os.makedirs(cf.download_dir, exist_ok=True)
+    tmp = tempfile.NamedTemporaryFile(dir=os.path.dirname(cf.db_path),
+                                      prefix='.tmp-', suffix='.sqlite',
+                                      delete=False)
+    try:
+        with tmp:
+            out = SnapshotWriter(tmp, codec)
+            have = False
+            if sha256 is not None and os.path.exists(dlpath):
+                out.write_file(dlpath)
+                have = (out.hexdigest() == sha256)
+                if have:
+                    periodic(message='using previous download of %s' % (
+                        dlname,))
+                else:
+                    out.reset()
+            if not have:
+                fetch_resumable(url, partpath, out, periodic=periodic,
+                                session=session)
+                os.rename(partpath, dlpath)
+            try:
+                out.finish(sha256)
+            except ValueError:
+                os.unlink(dlpath)
+                raise
+        cf.opendb(tmp.name)
+        os.chmod(tmp.name, 0o644)
+        os.rename(tmp.name, cf.db_path)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+    for name in os.listdir(cf.download_dir):
+        if name != dlname:
+            os.unlink(os.path.join(cf.download_dir, name))
+
+
+def snapshot_latest_version(latest):
+    # the top level version is that of the full snapshot at url, the
+    # deltas published since then bring it up to the last one's version
+    deltas = latest.get('deltas')
+    if deltas:
+        return list(deltas[-1]['to'])
+    return [latest.get('snapshot-started', 0),
+            latest.get('snapshot-updated', 0)]
+
+
+def snapshot_url(latest):
+    urls = latest.get('urls', {})
+    for codec in reversed(available_codecs()):
+        if codec in urls:
+            return urls[codec], codec
+    return latest['url'], 'gzip'
+
+
+def download_and_apply_deltas(deltas, periodic=noop, session=None):
+    data = []
+    for delta in deltas:
+        periodic(message='downloading %s' % (delta['url'],))
+        r = req_get(session, delta['url'])
+        if r.status_code != 200:
+            raise ValueError('failed to download %s: %d %s' % (
+                delta['url'], r.status_code, r.reason))
+        if 'sha256' in delta and \
+           hashlib.sha256(r.content).hexdigest() != delta['sha256']:
+            raise ValueError('checksum mismatch for %s' % (delta['url'],))
+        data.append(json.loads(gzip.decompress(r.content)))
+    periodic(message='applying %d database update(s)' % (len(data),))
+    apply_snapshot_deltas(cf.opendb(), data)
 
 
 def maybe_download_update(periodic=noop, session=None):
@@ -895,23 +1805,45 @@ def maybe_download_update(periodic=noop, session=None):
         print('no remote database available', file=sys.stderr)
         return
 
+    local = [current['snapshot-started'], current['snapshot-updated']]
+    remote = snapshot_latest_version(latest)
     if latest['schema-version'] != schema_version:
         print(schema_version_advice(latest['schema-version'], 'remote'),
               file=sys.stderr)
         sys.exit(1)
-    elif (latest['snapshot-started'] > current['snapshot-started'] or
-          (latest['snapshot-started'] == current['snapshot-started'] and
-           latest['snapshot-updated'] > current['snapshot-updated'])):
+    elif remote > local:
         periodic('Fetching database', 'updating from %d/%d to %d/%d' % (
-            current['snapshot-started'], current['snapshot-updated'],
-            latest['snapshot-started'], latest['snapshot-updated']))
-        download_and_install_snapshot(latest['url'], periodic=periodic,
-                                      session=session)
+            tuple(local) + tuple(remote)))
+        # use the deltas following the local snapshot if there are any,
+        # otherwise get the full snapshot and all the deltas after it
+        deltas = latest.get('deltas', [])
+        chain = next((deltas[i:] for i, d in enumerate(deltas)
+                      if d['from'] == local), None)
+        if chain is not None:
+            try:
+                download_and_apply_deltas(chain, periodic=periodic,
+                                          session=session)
+                return
+            except (ValueError, sqlite3.Error) as exc:
+                print('failed to apply database update: %s' % (exc,),
+                      file=sys.stderr)
+        url, codec = snapshot_url(latest)
+        download_and_install_snapshot(
+            url, codec=codec, sha256=latest.get('sha256', {}).get(codec),
+            periodic=periodic, session=session)
+        if deltas:
+            # the full snapshot is installed either way, a bad delta only
+            # leaves it somewhat older until the next run
+            try:
+                download_and_apply_deltas(deltas, periodic=periodic,
+                                          session=session)
+            except (ValueError, sqlite3.Error) as exc:
+                print('failed to apply database update: %s' % (exc,),
+                      file=sys.stderr)
     else:
         periodic('Database up to date',
                  'local version %d/%d not older than remote %d/%d' % (
-                     current['snapshot-started'], current['snapshot-updated'],
-                     latest['snapshot-started'], latest['snapshot-updated']))
+                     tuple(local) + tuple(remote)))
 
 
 def schema_version_advice(version, source):
@@ -956,6 +1888,12 @@ def main():
     parser.add_argument('-Q', dest='questing',
                         default=True, action='store_false',
                         help='Skip retrieving questing information')
+    parser.add_argument('-S', dest='schedule', action='store_true',
+                        help='Only update raiders whose quest or recruiting '
+                        'state is due to change')
+    parser.add_argument('--plan', dest='plan', action='store_true',
+                        help='Show when each raider is due for a scheduled '
+                        'update, without updating')
     args = parser.parse_args()
     if args.local and not args.nodownload:
         args.nodownload = True
@@ -968,20 +1906,33 @@ def main():
               file=sys.stderr)
         sys.exit(1)
 
-    session = cf.requests_session()
+    session = cf.requests_session(pool_maxsize=fetch_concurrency)
     cf.makedirs()
     if cf.can_update_remote and not args.nodownload:
         maybe_download_update(periodic=periodic_print, session=session)
     db = friendly_dbopen()
-    cr_auth = GoogAuth()
-    if args.local:
-        cr_auth.ensure_login(session, periodic=periodic_print)
 
     raiders = None
     if len(args.raider):
         raiders = ensure_raider_ids(db, args.raider, parser.print_usage,
                                     session=session)
 
+    if args.plan or args.schedule:
+        now_secs = timestamp_utc()
+        plan = plan_update(db, raiders, now_secs=now_secs)
+        if args.plan:
+            print_update_plan(plan, now_secs)
+            return
+        raiders = [rid for when, rid, name, reason in plan
+                   if when is not None and when <= now_secs]
+        if not raiders:
+            periodic_print('Scheduled update', 'no raiders are due')
+            return
+
+    cr_auth = GoogAuth()
+    if args.local:
+        cr_auth.ensure_login(session, periodic=periodic_print)
+
     maybe_load_geardb(db, forcelocal=args.local)
     res = request_update(raiders, gear=args.gear, recruiting=args.recruiting,
                          questing=args.questing, periodic=periodic_print,
@@ -3,6 +3,8 @@ import datetime
 import json
 import os
 import queue
+import shutil
+import sqlite3
 import sys
 import threading
 import time
@@ -19,6 +21,12 @@ cru = __import__('cr-update')
 latest = {}
 latest_lock = threading.Lock()
 latest_file = None
+# deltas are published on top of the last full snapshot, until there are
+# this many of them and a new full snapshot is made
+full_snapshot_every = 24
+published_db_path = None
+publish_lock = threading.Lock()
+update_stages = ('basic', 'gear', 'recruiting', 'questing')
 webapp = flask.Flask(__name__)
 api_key = None
 rebuilder = None
@@ -42,24 +50,27 @@ def update_latest(info):
     global latest
     with latest_lock:
         if info['schema-version'] == latest.get('schema-version') and \
-           (info['snapshot-started'] < latest.get('snapshot-started', 0) or
-            (info['snapshot-started'] == latest.get('snapshot-started', 0) and
-             info['snapshot-updated'] <= latest.get('snapshot-updated', 0))):
-            return
+           (cru.snapshot_latest_version(info) <=
+                cru.snapshot_latest_version(latest)):
+            return False
         latest = info
-        if latest_file is None:
-            return
-        with cru.permatempfile(latest_file, suffix='.json',
-                               binary=False) as fh:
-            json.dump(info, fh)
+        if latest_file is not None:
+            with cru.permatempfile(latest_file, suffix='.json',
+                                   binary=False) as fh:
+                json.dump(info, fh)
+        return True
 
 
-def load_geardb(path, trysql=()):
+def load_geardb(path, trysql=(), tryjson=()):
     global geardb_file
     geardb_file = path
     if os.path.exists(geardb_file):
-        geardb.load(open(geardb_file))
+        geardb.load_journal(geardb_file)
         return True
+    for jsonpath in tryjson:
+        if os.path.exists(jsonpath):
+            cru.convert_gear_json(jsonpath, geardb_file, geardb=geardb)
+            return True
     for dbpath in trysql:
         if os.path.exists(dbpath):
             db = cf.opendb(dbpath)
@@ -69,9 +80,11 @@ def load_geardb(path, trysql=()):
 
 
 def save_geardb():
-    with cru.permatempfile(geardb_file, suffix='.json',
-                           binary=False) as fh:
-        geardb.save(fh)
+    geardb.save_journal(geardb_file)
+
+
+def path_to_url(path):
+    return '%s/%s' % (flask.request.host_url.rstrip('/'), path.lstrip('/'))
 
 
 @webapp.route("/latest")
@@ -80,9 +93,14 @@ def handle_latest():
     if info.get('schema-version') != cru.schema_version:
         info = {}
     if 'path' in info:
-        info['url'] = '%s/%s' % (flask.request.host_url.rstrip('/'),
-                                 info['path'].lstrip('/'))
-        del info['path']
+        info['url'] = path_to_url(info.pop('path'))
+    if 'paths' in info:
+        info['urls'] = {k: path_to_url(v)
+                        for k, v in info.pop('paths').items()}
+    if 'deltas' in info:
+        info['deltas'] = [dict(((k, v) for k, v in d.items()
+                                if k != 'path'), url=path_to_url(d['path']))
+                          for d in info['deltas']]
     return info
 
 
@@ -112,7 +130,7 @@ def handle_update():
             continue
         elif key.startswith('no-'):
             short = key.split('-', 1)[1]
-            if short in ('basic', 'gear', 'recruiting', 'questing'):
+            if short in update_stages:
                 params[short] = False
                 continue
         return text_response('unknown parameter: %s' % (key,), 400)
@@ -151,7 +169,8 @@ class BaseThread(threading.Thread):
         self._wwwdir = wwwdir
         self._baseurlpath = baseurlpath.rstrip('/')
         self._lastsect = ''
-        self._session = cf.requests_session()
+        self._session = cf.requests_session(
+            pool_maxsize=cru.fetch_concurrency)
         self._exiting = False
         self._exitmsg = 'Server shutting down'
 
@@ -159,10 +178,10 @@ class BaseThread(threading.Thread):
         # yield control to signal handlers and other threads
         time.sleep(0.0001)
 
-    def _dbdump_filename(self, when):
+    def _dbdump_filename(self, when, suffix):
         when = datetime.datetime.fromtimestamp(when)
-        return 'raiders-v%d-%sZ.sqlite.gz' % (
-            cru.schema_version, when.isoformat(timespec='seconds'))
+        return 'raiders-v%d-%sZ%s' % (
+            cru.schema_version, when.isoformat(timespec='seconds'), suffix)
 
     def _periodic(self, section=None, message=None):
         if self._exiting:
@@ -179,7 +198,7 @@ class BaseThread(threading.Thread):
         except self.ExitThread:
             self._publish_eof()
 
-    def _update_db(self, db_path, params={}):
+    def _update_db(self, db_path, params={}, full=False):
         db = cf.opendb(db_path)
         cru.setupdb(db)
         self._periodic()
@@ -190,13 +209,69 @@ class BaseThread(threading.Thread):
         info, idlist = cru.import_or_update(db, **params)
         self._periodic('Publishing database', message='dated %d/%d' % (
             info['snapshot-started'], info['snapshot-updated']))
-        dumpfile = self._dbdump_filename(info['snapshot-updated'])
-        info['path'] = '%s/%s' % (self._baseurlpath, dumpfile)
-        cru.gzip_to(db_path, self._wwwdir, dumpfile, periodic=self._periodic)
-        update_latest(info)
+        self._publish_db(db, db_path, info, full=full)
         self._session.close()
         return info, idlist
 
+    def _publish_db(self, db, db_path, info, full=False):
+        deltafile = self._dbdump_filename(info['snapshot-updated'],
+                                          '.delta.json.gz')
+        version = [info['snapshot-started'], info['snapshot-updated']]
+        with publish_lock:
+            with latest_lock:
+                prev = latest.copy()
+            deltas = prev.get('deltas', [])
+            full = (full or 'full' not in prev or
+                    prev.get('schema-version') != info['schema-version'] or
+                    len(deltas) >= full_snapshot_every or
+                    not os.path.exists(published_db_path))
+            if not full:
+                try:
+                    delta = cru.write_snapshot_delta(
+                        db, published_db_path,
+                        os.path.join(self._wwwdir, deltafile))
+                    full = (delta['from'] !=
+                            cru.snapshot_latest_version(prev) or
+                            delta['to'] != version)
+                except sqlite3.Error as exc:
+                    self._periodic(message='delta failed: %s' % (exc,))
+                    full = True
+            if full:
+                info['paths'] = {}
+                info['sha256'] = {}
+                for codec in cru.available_codecs():
+                    dumpfile = self._dbdump_filename(
+                        info['snapshot-updated'],
+                        '.sqlite' + cru.snapshot_codecs[codec])
+                    info['sha256'][codec] = cru.compress_to(
+                        db_path, self._wwwdir, dumpfile, codec=codec,
+                        periodic=self._periodic)
+                    info['paths'][codec] = '%s/%s' % (self._baseurlpath,
+                                                      dumpfile)
+                info['path'] = info['paths']['gzip']
+                info['full'] = version
+                info['deltas'] = []
+            else:
+                self._periodic(message='published %d changed table(s)' % (
+                    len(delta['tables']),))
+                # the top level keeps describing the full snapshot, so
+                # that clients which only know about url stay consistent
+                info['snapshot-started'], info['snapshot-updated'] = \
+                    prev['full']
+                info['path'] = prev['path']
+                info['paths'] = prev.get('paths', {'gzip': prev['path']})
+                info['sha256'] = prev.get('sha256', {})
+                info['full'] = prev['full']
+                info['deltas'] = deltas + [{
+                    'from': delta['from'], 'to': delta['to'],
+                    'path': '%s/%s' % (self._baseurlpath, deltafile),
+                    'sha256': cru.file_sha256(
+                        os.path.join(self._wwwdir, deltafile))}]
+            if update_latest(info):
+                with cru.permatempfile(published_db_path) as tmp:
+                    with open(db_path, 'rb') as fh:
+                        shutil.copyfileobj(fh, tmp)
+
     def _publish_eof(self):
         self._publish_status(self._exitmsg)
         self._publish_status(None)
@@ -217,7 +292,8 @@ class RebuildThread(BaseThread):
                 self._periodic('Starting database rebuild')
                 if os.path.exists(db_path):
                     os.unlink(db_path)
-                _, all_rids = self._update_db(db_path)
+                _, all_rids = self._update_db(db_path, {'pipelined': True},
+                                              full=True)
                 all_raider_ids = set(all_rids)
                 os.rename(db_path, updater._new_db_path)
                 save_geardb()
@@ -255,15 +331,19 @@ class UpdateThread(BaseThread):
     def __init__(self, **kw):
         super().__init__('updater', **kw)
         self.__requests = queue.SimpleQueue()
-        self.__status = None
+        self.__status = []
         self._base_db_path = os.path.join(self._workdir, 'update-base.sqlite')
         self._new_db_path = os.path.join(self._workdir, 'new-base-db.sqlite')
 
     def _run(self):
         while True:
-            params, self.__status = self.__requests.get()
+            params, self.__status = self._next_update()
             try:
                 self._periodic('Starting database update')
+                if len(self.__status) > 1:
+                    self._periodic(message=(
+                        'merged %d requests for %d raider(s)' % (
+                            len(self.__status), len(params['raiders']))))
                 if os.path.exists(self._new_db_path):
                     os.rename(self._new_db_path, self._base_db_path)
                 self._update_db(self._base_db_path, params)
@@ -272,7 +352,25 @@ class UpdateThread(BaseThread):
                 self._periodic(message=traceback.format_exc())
             self._publish_status(None)
             self._lastsect = ''
-            self.__status = None
+            self.__status = []
+
+    def _next_update(self):
+        # wait for a request, then merge every other one already queued
+        # into a single update covering all of their raiders. a stage is
+        # only skipped if every merged request asked to skip it
+        pending = [self.__requests.get()]
+        while pending[-1][1] is not None:
+            try:
+                pending.append(self.__requests.get_nowait())
+            except queue.Empty:
+                break
+        pending = [(p, q) for p, q in pending if q is not None]
+        params = {'raiders': sorted(set().union(
+            *(p['raiders'] for p, q in pending)))}
+        for stage in update_stages:
+            if pending and not any(p.get(stage, True) for p, q in pending):
+                params[stage] = False
+        return params, [q for p, q in pending]
 
     def request_db_update(self, raiders, params={}):
         if self._exiting:
@@ -299,8 +397,8 @@ class UpdateThread(BaseThread):
         self.__requests.put((None, None))
 
     def _publish_status(self, msg):
-        if self.__status is not None:
-            self.__status.put(msg)
+        for i in self.__status:
+            i.put(msg)
 
 
 class QuitterServer(flup.server.fcgi.WSGIServer):
@@ -333,6 +431,8 @@ def main():
     workdir = os.path.expanduser('~/crudb-workdir')
     os.makedirs(workdir, exist_ok=True)
     load_latest(os.path.join(workdir, 'latest.json'))
+    global published_db_path
+    published_db_path = os.path.join(workdir, 'published.sqlite')
     all_raider_ids.update(*cru.get_raider_ids(session=cf.requests_session()))
 
     global rebuilder, updater
@@ -340,8 +440,9 @@ def main():
             'baseurlpath': args.dburlpath}
     rebuilder = RebuildThread(**thrp)
     updater = UpdateThread(**thrp)
-    load_geardb(os.path.join(workdir, 'gear.json'),
-                trysql=(updater._new_db_path, updater._base_db_path))
+    load_geardb(os.path.join(workdir, 'gear.journal'),
+                trysql=(updater._new_db_path, updater._base_db_path),
+                tryjson=(os.path.join(workdir, 'gear.json'),))
 
     rebuilder.start()
     updater.start()